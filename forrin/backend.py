@@ -1,16 +1,414 @@
 import os
+import re
+import zlib
+import struct
 import sqlite3
+import gettext
+import hashlib
+import threading
 
 import polib
+from six.moves.urllib.request import pathname2url
 
 from forrin.util import reify
 
+# Version of the catalog database schema, stored as SQLite's user_version.
+# Databases with a different version are rebuilt (or, if precompiled,
+# rejected).
+SCHEMA_VERSION = 4
+
+
+def connect(filename, readonly=False, **options):
+    """Open a catalog database
+
+    If readonly is false, the database is created, or rebuilt if it has an
+    old schema.
+    If readonly is true, the database must exist, and have the current
+    schema.
+    Other options are passed to sqlite3.connect.
+    """
+    if readonly:
+        try:
+            db = sqlite3.connect(
+                'file:%s?mode=ro' % pathname2url(os.path.abspath(filename)),
+                uri=True, **options)
+        except TypeError:
+            # Python 2 can't open databases read-only
+            db = sqlite3.connect(filename, **options)
+        [[version]] = db.execute('PRAGMA user_version')
+        if version != SCHEMA_VERSION:
+            raise ValueError(
+                '%s has catalog schema version %s, expected %s; '
+                'compile it again' % (filename, version, SCHEMA_VERSION))
+        return db
+    try:
+        db = sqlite3.connect(filename, **options)
+    except IOError:
+        # Can't connect, use temporary DB
+        db = sqlite3.connect(":memory:", **options)
+    create_schema(db)
+    return db
+
+
+def create_schema(db):
+    """Create the catalog tables, unless they exist in the current version
+
+    Catalogs can always be rebuilt from the .po files, so old tables are
+    simply dropped.
+    The schema is checked again and changed in an immediate transaction,
+    so processes opening a new database at the same time don't interfere.
+    """
+    [[version]] = db.execute('PRAGMA user_version')
+    if version == SCHEMA_VERSION:
+        return
+    # Manage the transaction here; the sqlite3 module would commit
+    # before DDL statements on some Python versions
+    db.commit()
+    isolation_level = db.isolation_level
+    db.isolation_level = None
+    try:
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            _create_tables(db)
+        except:
+            db.execute('ROLLBACK')
+            raise
+        db.execute('COMMIT')
+    finally:
+        db.isolation_level = isolation_level
+
+
+def _create_tables(db):
+    [[version]] = db.execute('PRAGMA user_version')
+    if version == SCHEMA_VERSION:
+        # Created by another connection in the meantime
+        return
+    for table in 'translation', 'language', 'source':
+        db.execute('DROP TABLE IF EXISTS %s' % table)
+
+    db.execute('''CREATE TABLE IF NOT EXISTS source (
+            id INTEGER PRIMARY KEY,
+            text TEXT UNIQUE)
+        ''')
+
+    db.execute('''CREATE TABLE IF NOT EXISTS language (
+            domain TEXT,
+            lang TEXT,
+            source_mtime INTEGER,
+            source_size INTEGER,
+            plural_forms TEXT,
+            key_filter BLOB,
+            PRIMARY KEY (domain, lang))
+        ''')
+
+    db.execute('''CREATE TABLE IF NOT EXISTS translation (
+            domain TEXT,
+            lang TEXT,
+            source_id INTEGER REFERENCES source(id),
+            plural_number INTEGER,
+            translation TEXT,
+            shard TEXT,
+            PRIMARY KEY (domain, lang, source_id, plural_number),
+            FOREIGN KEY (domain, lang) REFERENCES language(domain, lang))
+        ''')
+
+    db.execute('''CREATE INDEX IF NOT EXISTS translation_shard
+        ON translation (domain, lang, shard)''')
+
+    db.execute('PRAGMA user_version = %d' % SCHEMA_VERSION)
+
+
+def build_language(db, domain, lang, po_path):
+    """(Re)build the catalog of one language of a domain from its .po file
+
+    Fuzzy, obsolete and untranslated messages are left out.
+    The changes are not committed.
+
+    Messages are assigned to shards (see message_shard), which backends
+    load as a whole. A BloomFilter of the translated messages is stored
+    with the language.
+    """
+    stat = os.stat(po_path)
+    db.execute('''DELETE FROM translation
+            WHERE domain = ? AND lang = ?''', [domain, lang])
+    db.execute('''DELETE FROM language
+            WHERE domain = ? AND lang = ?''', [domain, lang])
+
+    po = polib.pofile(po_path)
+    rows = []
+    msgids = []
+    for message in po:
+        if message.obsolete or 'fuzzy' in message.flags:
+            continue
+        shard = message_shard(message)
+        if message.msgstr:
+            rows.append((message.msgid, 0, message.msgstr, shard))
+        for number, msgstr in sorted(message.msgstr_plural.items()):
+            if msgstr:
+                rows.append((message.msgid, int(number), msgstr, shard))
+        if message.msgstr or message.msgstr_plural:
+            msgids.append(message.msgid)
+
+    db.executemany('''INSERT OR IGNORE INTO source
+        (text) VALUES (?)
+        ''', ([msgid] for msgid in msgids))
+
+    db.executemany('''INSERT OR REPLACE INTO translation
+        (source_id, plural_number, domain, lang, translation, shard)
+        VALUES ((SELECT id FROM source WHERE text=?), ?, ?, ?, ?, ?)
+        ''', ((msgid, number, domain, lang, msgstr, shard)
+            for msgid, number, msgstr, shard in rows))
+
+    key_filter = BloomFilter.build(msgids)
+    db.execute('''INSERT INTO language
+        (domain, lang, source_mtime, source_size, plural_forms, key_filter)
+        VALUES (?, ?, ?, ?, ?, ?)
+        ''', (domain, lang, stat.st_mtime, stat.st_size,
+            po.metadata.get('Plural-Forms'),
+            sqlite3.Binary(key_filter.to_bytes())))
+
+
+def remove_unused_sources(db):
+    """Remove source strings no domain has translations for"""
+    db.execute('''DELETE FROM source WHERE id NOT IN (
+        SELECT source_id FROM translation)''')
+
+
+def message_shard(message):
+    """Return the name of the shard a POEntry belongs to
+
+    Messages are grouped by the source file they first occur in, so a
+    process only loads translations of modules it uses. Messages without
+    occurrences (e.g. in stripped catalogs) are grouped by a hash.
+    """
+    if message.occurrences:
+        return message.occurrences[0][0]
+    return '#%d' % (zlib.crc32(message.msgid.encode('utf-8')) % 64)
+
+
+class BloomFilter(object):
+    """A compact set of strings, which may give false positives
+
+    If a string is not in the filter, it was definitely not added to it.
+    """
+    hash_count = 7
+
+    def __init__(self, data):
+        self.bits = bytearray(data)
+        self.size = len(self.bits) * 8
+
+    @classmethod
+    def build(cls, keys, bits_per_key=10):
+        """Return a filter containing the given keys
+
+        With the default bits_per_key, about 1% of other keys are false
+        positives.
+        """
+        keys = list(keys)
+        result = cls(bytearray(len(keys) * bits_per_key // 8 + 8))
+        for key in keys:
+            result.add(key)
+        return result
+
+    def _positions(self, key):
+        first, second = struct.unpack(
+            '<QQ', hashlib.md5(key.encode('utf-8')).digest())
+        size = self.size
+        return [(first + i * second) % size for i in range(self.hash_count)]
+
+    def add(self, key):
+        bits = self.bits
+        for position in self._positions(key):
+            bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, key):
+        bits = self.bits
+        for position in self._positions(key):
+            if not bits[position >> 3] & (1 << (position & 7)):
+                return False
+        return True
+
+    def to_bytes(self):
+        return bytes(self.bits)
+
+
+def verify_catalog(db, max_n=1000):
+    """Check a catalog database, raise ValueError if it is not usable
+
+    Checks the database's integrity, that each language's plural
+    forms expression gives valid plural form numbers for n up to max_n,
+    and that its key filter contains all its translated messages.
+    """
+    problems = [row for [row] in db.execute('PRAGMA integrity_check')
+        if row != 'ok']
+    if problems:
+        raise ValueError('Catalog is corrupted: %s' % '; '.join(problems))
+    for domain, lang, plural_forms, max_number in db.execute('''
+            SELECT language.domain, language.lang, language.plural_forms,
+                MAX(translation.plural_number)
+            FROM language
+            LEFT JOIN translation ON (translation.domain = language.domain
+                AND translation.lang = language.lang)
+            GROUP BY language.domain, language.lang
+            '''):
+        lang = '%s/%s' % (domain, lang)
+        nplurals, plural = parse_plural_forms(plural_forms)
+        if max_number is not None and max_number >= nplurals:
+            raise ValueError('%s: translation for plural form %s, '
+                'but there are only %s' % (lang, max_number, nplurals))
+        for n in range(max_n + 1):
+            if not 0 <= plural(n) < nplurals:
+                raise ValueError('%s: bad plural form for n=%s: %s' % (
+                    lang, n, plural(n)))
+    for domain, lang, data in db.execute('''
+            SELECT domain, lang, key_filter FROM language
+            ''').fetchall():
+        key_filter = BloomFilter(data or b'')
+        for [msgid] in db.execute('''SELECT DISTINCT source.text
+                FROM source
+                INNER JOIN translation ON (source.id = translation.source_id)
+                WHERE translation.domain = ? AND translation.lang = ?
+                ''', [domain, lang]):
+            if msgid not in key_filter:
+                raise ValueError('%s/%s: key filter is missing %r' % (
+                    domain, lang, msgid))
+
+
+def parse_plural_forms(plural_forms):
+    """Parse a Plural-Forms header; return (nplurals, plural function)
+
+    The function maps a number to the index of the plural form to use.
+    If there's no header, English rules are used.
+    """
+    if not plural_forms:
+        return 2, _germanic_plural
+    nplurals = re.search(r'nplurals\s*=\s*(\d+)', plural_forms)
+    plural = re.search(r'plural\s*=\s*([^;]+)', plural_forms)
+    if nplurals is None or plural is None:
+        raise ValueError('Invalid Plural-Forms: %r' % plural_forms)
+    return int(nplurals.group(1)), gettext.c2py(plural.group(1).strip())
+
+
+def _germanic_plural(n):
+    return int(n != 1)
+
+
+class CatalogStore(object):
+    """A catalog database, which can hold catalogs of many domains
+
+    Source strings are stored once, and shared by all domains.
+    The connection can be used from any thread; builds are serialized
+    by the store's lock.
+    Use get_store to share stores in a process.
+    """
+    def __init__(self, filename, readonly=False):
+        self.filename = filename
+        self.readonly = readonly
+        self.db = connect(filename, readonly, check_same_thread=False)
+        self.lock = threading.Lock()
+
+    def has_language(self, domain, lang):
+        return self.db.execute('''
+                SELECT 1 FROM language WHERE domain = ? AND lang = ?
+                ''', [domain, lang]).fetchone() is not None
+
+    def is_current(self, domain, lang, stat):
+        """Return true if a language is built from a file with given stat"""
+        for mtime, size in self.db.execute('''
+                SELECT source_mtime, source_size
+                FROM language
+                WHERE domain = ? AND lang = ?
+                ''', [domain, lang]):
+            return mtime == stat.st_mtime and size == stat.st_size
+        return False
+
+    def build(self, domain, lang, po_path):
+        """(Re)build a language, and commit"""
+        with self.lock:
+            build_language(self.db, domain, lang, po_path)
+            self.db.commit()
+
+    def close(self):
+        self.db.close()
+
+
+def get_store(filename, readonly=False):
+    """Return the CatalogStore for a file, shared in this process
+
+    If the file was replaced since the store was opened (for example, by
+    compiling the catalogs again), a new store is opened.
+    """
+    key = os.path.abspath(filename), readonly, os.getpid()
+    try:
+        stat = os.stat(filename)
+        file_id = stat.st_dev, stat.st_ino
+    except OSError:
+        file_id = None
+    try:
+        store, store_file_id = _stores[key]
+    except KeyError:
+        pass
+    else:
+        if store_file_id == file_id:
+            return store
+    store = CatalogStore(filename, readonly)
+    if file_id is None:
+        stat = os.stat(filename)
+        file_id = stat.st_dev, stat.st_ino
+    _stores[key] = store, file_id
+    return store
+
+_stores = {}
+
 
 class SQLiteBackend(object):
-    def __init__(self, domain, directory, languages, _db=None):
+    """Translations from .po files, cached in a SQLite database
+
+    The database is kept next to the .po files, as <domain>.forrin-db, and
+    languages are rebuilt when their .po file changes.
+    Alternatively, a CatalogStore for the database can be given as store;
+    one store can be shared by many domains.
+
+    If precompiled is true, the database must have been built beforehand
+    (with ForrinTools' compile action). It is opened read-only, and .po
+    files are not looked at.
+
+    Translations are loaded into memory one shard at a time, when a message
+    from the shard is first looked up. Messages not in the language's key
+    filter are known to be untranslated without querying the database.
+    """
+    # Maximum number of remembered untranslated messages (see lookup)
+    max_misses = 10000
+
+    def __init__(self, domain, directory, languages, store=None,
+            recorder=None, precompiled=False):
         self.domain = domain
         self.directory = directory
+        self.recorder = recorder
+        self.precompiled = precompiled
+        # msgid -> {plural number: translation}, or None if not translated
+        self._catalog = {}
+        # Recently looked up messages that are not translated
+        self._misses = set()
+        self._loaded_shards = set()
+
+        # Skip languages without a catalog
+        if store is None and languages:
+            store = get_store(
+                os.path.join(directory, '%s.forrin-db' % domain),
+                readonly=precompiled)
+        self.store = store
+        while languages:
+            if precompiled:
+                found = store.has_language(domain, languages[0])
+            else:
+                found = os.path.exists(
+                    os.path.join(directory, '%s.po' % languages[0]))
+            if found:
+                break
+            languages = languages[1:]
         self.languages = languages
+
         if self.languages:
             self.lang = self.languages[0]
         else:
@@ -18,98 +416,249 @@ class SQLiteBackend(object):
             self.ngettext = self.ngettext_source
             return
 
-        self.po_path = os.path.join(directory, '%s.po' % self.lang)
-        if not os.path.exists(self.po_path):
-            return self.__init__(domain, directory, languages[1:])
-
-        if _db:
-            self.db = _db
-        else:
-            db_filename = os.path.join(directory, '%s.forrin-db' % domain)
-            try:
-                self.db = sqlite3.connect(db_filename)
-            except IOError:
-                # Can't connect, use temporary DB
-                self.db = sqlite3.connect(":memory:")
-
-            self.db.execute('''CREATE TABLE IF NOT EXISTS source (
-                    id INTEGER PRIMARY KEY,
-                    text TEXT UNIQUE)
-                ''')
-
-            self.db.execute('''CREATE TABLE IF NOT EXISTS language (
-                    lang TEXT PRIMARY KEY,
-                    source_mtime INTEGER,
-                    source_size INTEGER)
-                ''')
-
-            self.db.execute('''CREATE TABLE IF NOT EXISTS translation (
-                    source_id INTEGER REFERENCES source(id),
-                    lang TEXT REFERENCES language(lang),
-                    plural_number INTEGER,
-                    translation TEXT,
-                    PRIMARY KEY (source_id, lang, plural_number))
-                ''')
+        self.db = store.db
+        if precompiled:
+            return
 
+        self.po_path = os.path.join(directory, '%s.po' % self.lang)
         stat = os.stat(self.po_path)
+        if not store.is_current(domain, self.lang, stat):
+            if recorder is not None:
+                start = recorder.clock()
+            store.build(domain, self.lang, self.po_path)
+            if recorder is not None:
+                recorder.add_time('backend.build', start)
 
-        must_recreate = True
-        for mtime, size in self.db.execute('''
-                SELECT source_mtime, source_size
-                FROM language
-                WHERE lang = ?
-                ''', [self.lang]):
-            if mtime == stat.st_mtime and size == stat.st_size:
-                must_recreate = False
+    @reify
+    def fallback(self):
+        remaining_languages = self.languages[1:]
+        return SQLiteBackend(self.domain, self.directory, remaining_languages,
+            store=self.store, recorder=self.recorder,
+            precompiled=self.precompiled)
 
-        if must_recreate:
-            self.db.execute('''DELETE FROM translation
-                    WHERE lang = ?''', [self.lang])
-            self.db.execute('''DELETE FROM language
-                    WHERE lang = ?''', [self.lang])
+    @reify
+    def plural_forms(self):
+        """The Plural-Forms header of this language's catalog, or None"""
+        for [plural_forms] in self.db.execute('''
+                SELECT plural_forms FROM language WHERE domain = ? AND lang = ?
+                ''', [self.domain, self.lang]):
+            return plural_forms
+        return None
 
-            messages = [m for m in polib.pofile(self.po_path) if
-                m.msgstr and not (m.obsolete or 'fuzzy' in m.flags)]
+    @reify
+    def plural(self):
+        """Function mapping a number to the plural form index to use"""
+        return parse_plural_forms(self.plural_forms)[1]
 
-            self.db.executemany('''INSERT OR IGNORE INTO source
-                (text) VALUES (?)
-                ''', ([m.msgid] for m in messages))
+    @reify
+    def key_filter(self):
+        """BloomFilter of messages translated in this language, or None"""
+        for [data] in self.db.execute('''
+                SELECT key_filter FROM language WHERE domain = ? AND lang = ?
+                ''', [self.domain, self.lang]):
+            if data is not None:
+                return BloomFilter(data)
+        return None
 
-            self.db.executemany('''INSERT INTO translation
-                (plural_number, source_id, lang, translation)
-                VALUES (0, (SELECT id FROM SOURCE WHERE text=?), ?, ?)
-                ''', ((m.msgid, self.lang, m.msgstr) for m in messages))
+    @property
+    def source_path(self):
+        """The file this language's catalog comes from"""
+        if self.precompiled:
+            return self.store.filename
+        else:
+            return self.po_path
 
-            self.db.execute('''INSERT INTO language
-                (lang, source_mtime, source_size) VALUES (?, ?, ?)
-                ''', (self.lang, stat.st_mtime, stat.st_size))
+    def snapshot(self):
+        """Return the state loaded so far, for restore
 
-            self.db.commit()
+        The state is a picklable list with an item for this language and
+        each fallback created so far. Each item records the mtime and size
+        of the catalog's source file.
+        """
+        state = []
+        backend = self
+        while backend.languages:
+            stat = os.stat(backend.source_path)
+            if backend.key_filter is None:
+                key_filter = None
+            else:
+                key_filter = backend.key_filter.to_bytes()
+            state.append(dict(
+                lang=backend.lang,
+                source_mtime=stat.st_mtime,
+                source_size=stat.st_size,
+                plural_forms=backend.plural_forms,
+                key_filter=key_filter,
+                catalog=backend._catalog,
+                shards=sorted(backend._loaded_shards),
+            ))
+            if 'fallback' not in backend.__dict__:
+                break
+            backend = backend.fallback
+        return state
 
-    @reify
-    def fallback(self):
-        remaining_languages = self.languages[1:]
-        return SQLiteBackend(self.domain, self.directory, remaining_languages,
-            _db=self.db)
+    def restore(self, state):
+        """Restore state returned by snapshot
+
+        If the languages differ, or any of the source files changed since
+        the snapshot was taken, nothing is restored and False is returned.
+        """
+        backends = []
+        backend = self
+        for item in state:
+            if backends:
+                backend = backend.fallback
+            if not backend.languages or backend.lang != item['lang']:
+                return False
+            stat = os.stat(backend.source_path)
+            if (stat.st_mtime != item['source_mtime'] or
+                    stat.st_size != item['source_size']):
+                return False
+            backends.append(backend)
+        for backend, item in zip(backends, state):
+            backend._catalog = dict(item['catalog'])
+            backend._loaded_shards = set(item['shards'])
+            # Plural functions can't be pickled; parse the header again
+            backend.plural_forms = item['plural_forms']
+            backend.plural = parse_plural_forms(item['plural_forms'])[1]
+            if item['key_filter'] is None:
+                backend.key_filter = None
+            else:
+                backend.key_filter = BloomFilter(item['key_filter'])
+        return True
 
     def gettext_source(self, msgid):
+        if self.recorder is not None:
+            self.recorder.count('backend.miss')
         return msgid
 
     def ngettext_source(self, msgid, plural, n):
+        if self.recorder is not None:
+            self.recorder.count('backend.miss')
         if n == 1:
             return msgid
         else:
             return plural
 
+    def lookup(self, msgid):
+        """Return {plural number: translation} for msgid, or None
+
+        Loads the message's shard if needed.
+        Misses are remembered in a set of at most max_misses messages,
+        which is cleared when it fills up, so looking up arbitrary strings
+        doesn't use more and more memory.
+        """
+        catalog = self._catalog
+        try:
+            return catalog[msgid]
+        except KeyError:
+            pass
+        misses = self._misses
+        if msgid in misses:
+            return None
+        if len(misses) >= self.max_misses:
+            misses.clear()
+        key_filter = self.key_filter
+        if key_filter is not None and msgid not in key_filter:
+            misses.add(msgid)
+            return None
+        row = self.db.execute('''SELECT translation.shard
+            FROM translation
+            INNER JOIN source ON (source.id = translation.source_id)
+            WHERE translation.domain=? AND translation.lang=? AND source.text=?
+            LIMIT 1
+            ''', [self.domain, self.lang, msgid]).fetchone()
+        if row is not None and row[0] not in self._loaded_shards:
+            self.load_shard(row[0])
+        forms = catalog.get(msgid)
+        if forms is None:
+            misses.add(msgid)
+        return forms
+
+    def preload(self, msgids):
+        """Load translations of the given messages, in this language and
+        the fallbacks
+        """
+        if not self.languages:
+            return
+        catalog = self._catalog
+        msgids = [m for m in set(msgids) if m not in catalog]
+        for start in range(0, len(msgids), 500):
+            chunk = msgids[start:start + 500]
+            for text, number, msgstr in self.db.execute('''
+                    SELECT source.text, translation.plural_number,
+                        translation.translation
+                    FROM source
+                    INNER JOIN translation ON (source.id = translation.source_id)
+                    WHERE translation.domain=? AND translation.lang=?
+                        AND source.text IN (%s)
+                    ''' % ', '.join('?' * len(chunk)),
+                    [self.domain, self.lang] + chunk):
+                forms = catalog.get(text)
+                if forms is None:
+                    forms = catalog[text] = {}
+                forms[number] = msgstr
+        missing = [m for m in msgids if m not in catalog]
+        for msgid in missing:
+            catalog[msgid] = None
+        self.fallback.preload(missing)
+
+    def load_shard(self, shard):
+        """Load translations of all messages in a shard"""
+        recorder = self.recorder
+        if recorder is not None:
+            start = recorder.clock()
+        self._loaded_shards.add(shard)
+        catalog = self._catalog
+        for text, number, msgstr in self.db.execute('''
+                SELECT source.text, translation.plural_number,
+                    translation.translation
+                FROM source
+                INNER JOIN translation ON (source.id = translation.source_id)
+                WHERE translation.domain=? AND translation.lang=?
+                    AND translation.shard=?
+                ''', (self.domain, self.lang, shard)):
+            forms = catalog.get(text)
+            if forms is None:
+                forms = catalog[text] = {}
+            forms[number] = msgstr
+        if recorder is not None:
+            recorder.add_time('backend.load', start)
+
+    def plural_entries(self, msgid):
+        """Return the translations of a plural message in all languages
+
+        Returns a list of (Plural-Forms header, {plural number: translation})
+        pairs, for this language and the fallbacks that translate msgid,
+        in order. ngettext uses the first one that has the needed form.
+        """
+        entries = []
+        backend = self
+        while backend.languages:
+            forms = backend.lookup(msgid)
+            if forms:
+                entries.append((backend.plural_forms, forms))
+            backend = backend.fallback
+        return entries
+
     def gettext(self, msgid, _n=0):
-        for [msgstr] in self.db.execute('''SELECT translation.translation
-                FROM translation
-                INNER JOIN source ON (source.id = translation.source_id)
-                WHERE translation.lang=? AND source.text=? AND plural_number=?
-                ''', (self.lang, msgid, _n)):
-            return msgstr
+        forms = self.lookup(msgid)
+        if forms is not None and _n in forms:
+            if self.recorder is not None:
+                self.recorder.count('backend.hit')
+            return forms[_n]
+        if self.recorder is not None:
+            self.recorder.count('backend.fallback')
         return self.fallback.gettext(msgid)
 
     def ngettext(self, msgid, plural, n):
-        # XXX: implement
-        return self.gettext(msgid)
+        forms = self.lookup(msgid)
+        if forms is not None:
+            number = self.plural(n)
+            if number in forms:
+                if self.recorder is not None:
+                    self.recorder.count('backend.hit')
+                return forms[number]
+        if self.recorder is not None:
+            self.recorder.count('backend.fallback')
+        return self.fallback.ngettext(msgid, plural, n)
@@ -0,0 +1,406 @@
+# Encoding: UTF-8
+
+"""Benchmarks for Forrin
+
+Run as a module to run all benchmarks, or give benchmark names to run some:
+
+    python -m forrin.benchmark [--size N] [--save FILE] [--compare FILE] [NAME ...]
+
+Each benchmark yields (label, value, unit) triples; times are the best time
+of a single call of the measured operation.
+Benchmarks take a size argument (--size), the amount of synthetic data to
+use -- for example, number of messages in generated catalogs.
+
+Results can be saved to a JSON file with --save, and later runs compared
+to them with --compare.
+"""
+
+from __future__ import print_function, unicode_literals, division
+
+import os
+import sys
+import ast
+import json
+import shutil
+import timeit
+import argparse
+import tempfile
+import contextlib
+
+import six
+import polib
+
+try:
+    import tracemalloc
+except ImportError:
+    # Python 2: memory benchmarks are not available
+    tracemalloc = None
+
+import forrin.cs
+import forrin.en
+import forrin.extract
+import forrin.backend
+import forrin.instrument
+import forrin.translator
+import forrin.tools
+
+
+def best_time(func, number, repeat=3):
+    """Return the best time of a single call of func, in seconds"""
+    timer = timeit.Timer(func)
+    return min(timer.repeat(repeat=repeat, number=number)) / number
+
+
+def traced_memory(func):
+    """Return the number of bytes allocated by func and still alive after it
+
+    The result of func is kept alive until the memory is measured.
+    """
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        result = func()
+        after = tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+    del result
+    return after - before
+
+
+def peak_memory(func):
+    """Return the peak number of bytes allocated while func runs"""
+    tracemalloc.start()
+    try:
+        func()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def best_run(func, setup=None, repeat=3):
+    """Return the best time of func, running setup before each run"""
+    times = []
+    for i in range(repeat):
+        if setup is not None:
+            setup()
+        start = forrin.instrument.clock()
+        func()
+        times.append(forrin.instrument.clock() - start)
+    return min(times)
+
+
+@contextlib.contextmanager
+def synthetic_project(size=1000, languages=('cs', 'de', 'fr')):
+    """Create a temporary project with size messages; yield its directory
+
+    Sources are in the src subdirectory, 50 messages per module. Every
+    fifth message has a plural, and every seventh a context.
+    Catalogs for the given languages are in i18n; the first language
+    has plural forms of Czech. Each language lacks translations of some
+    messages, every (10 + its index)th.
+    """
+    directory = tempfile.mkdtemp()
+    try:
+        src_dir = os.path.join(directory, 'src')
+        i18n_dir = os.path.join(directory, 'i18n')
+        os.mkdir(src_dir)
+        os.mkdir(i18n_dir)
+        messages = synthetic_messages(size)
+        for start in range(0, size, 50):
+            lines = ['def function(x):']
+            for msgid, plural, context in messages[start:start + 50]:
+                if context:
+                    msgid = msgid.split('|', 1)[1]
+                args = [repr(msgid)]
+                if plural:
+                    args += [repr(plural), 'n=x']
+                if context:
+                    args.append('context=%r' % context)
+                lines.append('    print(_(%s))' % ', '.join(args))
+            filename = os.path.join(src_dir, 'module_%d.py' % start)
+            with open(filename, 'w') as fileobj:
+                fileobj.write('\n'.join(lines) + '\n')
+        for index, lang in enumerate(languages):
+            po = polib.POFile()
+            if index == 0:
+                po.metadata['Plural-Forms'] = (
+                    'nplurals=3; plural=(n==1) ? 0 : (n>=2 && n<=4) ? 1 : 2;')
+            else:
+                po.metadata['Plural-Forms'] = 'nplurals=2; plural=(n != 1);'
+            nplurals = 3 if index == 0 else 2
+            for number, (msgid, plural, context) in enumerate(messages):
+                if number % (10 + index) == 0:
+                    continue
+                entry = polib.POEntry(msgid=msgid)
+                if plural:
+                    entry.msgid_plural = plural
+                    entry.msgstr_plural = dict(
+                        (i, '%s %s %d' % (lang, plural, i))
+                        for i in range(nplurals))
+                else:
+                    entry.msgstr = '%s %s' % (lang, msgid)
+                po.append(entry)
+            po.save(os.path.join(i18n_dir, '%s.po' % lang))
+        yield directory
+    finally:
+        shutil.rmtree(directory)
+
+
+def synthetic_messages(size):
+    """Return a list of (msgid, plural, context) for synthetic_project
+
+    msgid includes the context, as in catalogs.
+    """
+    messages = []
+    for number in range(size):
+        msgid = 'message %d' % number
+        plural = context = None
+        if number % 5 == 0:
+            plural = 'messages %d' % number
+        if number % 7 == 0:
+            context = 'context'
+            msgid = 'context|' + msgid
+            if plural:
+                plural = 'context|' + plural
+        messages.append((msgid, plural, context))
+    return messages
+
+
+def project_translator(directory):
+    """Return a translator class for a synthetic_project"""
+    class Translator(forrin.translator.BaseTranslator):
+        package = 'forrin_benchmark'
+        i18n_directory = os.path.join(directory, 'i18n')
+    return Translator
+
+
+@contextlib.contextmanager
+def quiet():
+    """Suppress output to stdout"""
+    stdout = sys.stdout
+    sys.stdout = six.StringIO()
+    try:
+        yield
+    finally:
+        sys.stdout = stdout
+
+
+def bench_template(size=100000):
+    """Template formatting, compared to plain str.format"""
+    number = size
+    plain = '{0} files in {1}'
+    yield 'str.format', best_time(
+        lambda: plain.format('42', 'home'), number) * 1e6, 'µs'
+    template = forrin.cs.Template(plain)
+    yield 'cs.Template, no inflection', best_time(
+        lambda: template.format('42', 'home'), number) * 1e6, 'µs'
+    template = forrin.cs.Template('{0} files in {1:case=6}')
+    yield 'cs.Template, one inflected field', best_time(
+        lambda: template.format('42', 'mladý'), number) * 1e6, 'µs'
+    template = forrin.en.Template('{=a:*0} {0}')
+    yield 'en.Template, indefinite article', best_time(
+        lambda: template.format('apple'), number) * 1e6, 'µs'
+
+
+def bench_word_memory(size=1000000):
+    """Memory used by words, per word, compared to plain strings"""
+    count = size
+    if tracemalloc is None:
+        return
+    texts = ['slovo%dý' % i for i in range(count)]
+    for label, func in [
+            ('str', lambda: [''.join(t) for t in texts]),
+            ('cs.Word', lambda: [forrin.cs.Word.create(t) for t in texts]),
+            ('cs.Word with props', lambda: [
+                forrin.cs.Word.create(t, gender='f', animate=False)
+                for t in texts]),
+            ('en.Word', lambda: [forrin.en.Word.create(t) for t in texts]),
+        ]:
+        yield label, traced_memory(func) / count, 'B'
+
+
+def generated_module(functions=2000, depth=20):
+    """Return source of a large module, with messages in nested code"""
+    lines = []
+    for i in range(functions):
+        lines.append('def function_%d(x):' % i)
+        lines.append('    print(_("message %d") %% x)' % i)
+        lines.append('    return _("{n} items", "{n} items", n=x).format(n=x)')
+    nested = '_("deep %d")'
+    for i in range(depth):
+        nested = 'f(%s, [%s])' % (nested, i)
+    for i in range(functions):
+        lines.append('value = %s' % nested % i)
+    return '\n'.join(lines) + '\n'
+
+
+def bench_extract(size=2000, number=3):
+    """Extraction from a large generated module"""
+    source = generated_module(functions=size)
+    yield 'extract_from_string, large module', best_time(
+        lambda: list(forrin.extract.extract_from_string(source, 'gen.py')),
+        number) * 1e3, 'ms'
+    yield 'extract_from_string, large module, tokenize', best_time(
+        lambda: list(forrin.extract.extract_from_string(
+            source, 'gen.py', method='tokenize')),
+        number) * 1e3, 'ms'
+    no_messages = source.replace('_(', 'f(')
+    yield 'extract_from_string, no messages', best_time(
+        lambda: list(forrin.extract.extract_from_string(
+            no_messages, 'gen.py')),
+        number) * 1e3, 'ms'
+    tree = compile(source, 'gen.py', 'exec', ast.PyCF_ONLY_AST)
+    yield 'from_ast, large module', best_time(
+        lambda: list(forrin.extract.from_ast(tree, 'gen.py', ['_'])),
+        number) * 1e3, 'ms'
+
+
+def bench_translator(size=1000, number=10000):
+    """Translator calls: found, in a fallback language, and missing"""
+    with synthetic_project(size) as directory:
+        Translator = project_translator(directory)
+        _ = Translator(['cs', 'de'])
+        for label, args, kwargs in [
+                ('hit', ['message 1'], {}),
+                ('fallback', ['message 10'], {}),
+                ('miss', ['no such message'], {}),
+                ('plural', ['message 5', 'messages 5'], dict(n=3)),
+                ('context', ['message 7'], dict(context='context')),
+            ]:
+            _(*args, **kwargs)
+            yield label, best_time(
+                lambda: _(*args, **kwargs), number) * 1e6, 'µs'
+        source = Translator(['en'])
+        yield 'source language', best_time(
+            lambda: source('message 1'), number) * 1e6, 'µs'
+        identity = lambda message: message
+        yield 'bare function call', best_time(
+            lambda: identity('message 1'), number) * 1e6, 'µs'
+
+
+def bench_backend(size=10000):
+    """Building the SQLite catalog of a language"""
+    with synthetic_project(size) as directory:
+        i18n_dir = os.path.join(directory, 'i18n')
+        db_name = os.path.join(i18n_dir, 'forrin_benchmark.forrin-db')
+        po_name = os.path.join(i18n_dir, 'cs.po')
+
+        def build():
+            forrin.backend.SQLiteBackend('forrin_benchmark', i18n_dir, ['cs'])
+
+        def remove_db():
+            if os.path.exists(db_name):
+                os.unlink(db_name)
+
+        def touch_po():
+            stat = os.stat(po_name)
+            os.utime(po_name, (stat.st_atime, stat.st_mtime + 1))
+
+        yield 'cold build', best_run(build, remove_db) * 1e3, 'ms'
+        yield 'rebuild', best_run(build, touch_po) * 1e3, 'ms'
+        yield 'open, up to date', best_run(build) * 1e3, 'ms'
+        if tracemalloc is not None:
+            remove_db()
+            yield 'cold build, peak memory', peak_memory(build) / 1e6, 'MB'
+
+
+def bench_snapshot(size=10000):
+    """Warming up a translator: preloading messages vs. restoring a snapshot
+    """
+    with synthetic_project(size) as directory:
+        Translator = project_translator(directory)
+        # Strip the contexts, which preload adds back
+        messages = [
+            (msgid.split('|')[-1], plural and plural.split('|')[-1], context)
+            for msgid, plural, context in synthetic_messages(size)]
+        path = os.path.join(directory, 'snapshot')
+
+        def preload():
+            Translator(['cs', 'de']).preload(messages)
+
+        def restore():
+            Translator(['cs', 'de']).restore_snapshot(path)
+
+        _ = Translator(['cs', 'de'])
+        _.preload(messages)
+        _.save_snapshot(path)
+        yield 'preload', best_run(preload) * 1e3, 'ms'
+        yield 'restore snapshot', best_run(restore) * 1e3, 'ms'
+
+
+def bench_tools(size=10000):
+    """ForrinTools actions on a whole project"""
+    with synthetic_project(size) as directory:
+        tools = forrin.tools.ForrinTools(project_translator(directory),
+            source_dir=os.path.join(directory, 'src'))
+
+        def run(*args):
+            with quiet():
+                tools.run(['forrin', '-q'] + list(args))
+
+        for label, args in [
+                ('extract, no cache', ['extract', '--no-cache']),
+                ('extract, cached', ['extract']),
+                ('update', ['update', '--existing-pot']),
+                ('stats', ['stats', '--existing-pot']),
+                ('compile', ['compile']),
+            ]:
+            yield label, best_run(lambda: run(*args)) * 1e3, 'ms'
+        if tracemalloc is not None:
+            yield 'update, peak memory', peak_memory(
+                lambda: run('update', '--existing-pot')) / 1e6, 'MB'
+
+
+benchmarks = dict(
+    backend=bench_backend,
+    extract=bench_extract,
+    snapshot=bench_snapshot,
+    template=bench_template,
+    tools=bench_tools,
+    translator=bench_translator,
+    word_memory=bench_word_memory,
+)
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog='python -m forrin.benchmark',
+        description='Run Forrin benchmarks')
+    parser.add_argument('names', metavar='NAME', nargs='*',
+        help='Benchmarks to run: %s. Default: all' % ', '.join(
+            sorted(benchmarks)))
+    parser.add_argument('-s', '--size', type=int,
+        help='Size of synthetic data. Each benchmark has its own default')
+    parser.add_argument('--save', metavar='FILE',
+        help='Save results to a JSON file')
+    parser.add_argument('--compare', metavar='FILE',
+        help='Compare results to ones saved in a JSON file')
+    args = parser.parse_args(argv[1:])
+
+    if args.compare:
+        with open(args.compare) as fileobj:
+            baseline = json.load(fileobj)
+    else:
+        baseline = {}
+    results = {}
+    for name in args.names or sorted(benchmarks):
+        benchmark = benchmarks[name]
+        if args.size:
+            values = benchmark(args.size)
+        else:
+            values = benchmark()
+        for label, value, unit in values:
+            key = '%s: %s' % (name, label)
+            results[key] = dict(value=value, unit=unit)
+            line = '{0:12} {1:40} {2:10.3f} {3}'.format(
+                name, label, value, unit)
+            previous = baseline.get(key, {}).get('value')
+            if previous:
+                line += ' {0:+7.1f}%'.format((value / previous - 1) * 100)
+            print(line)
+    if args.save:
+        with open(args.save, 'w') as fileobj:
+            json.dump(results, fileobj, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main(sys.argv)
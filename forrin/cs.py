@@ -7,10 +7,12 @@ from __future__ import print_function, unicode_literals
 
 import six
 
-from forrin.template import Formatter, BaseWord, parse_bool
+from forrin.template import Formatter, BaseWord, BaseTemplate, parse_bool
 
 
 class Word(BaseWord):
+    __slots__ = ()
+
     @classmethod
     def guess_type(cls, word, **props):
         if word.endswith('í'):
@@ -22,8 +24,11 @@ class Word(BaseWord):
 
 
 class Adjective(Word):
-    def __init__(self, word):
-        self.root = word
+    __slots__ = ()
+
+    @property
+    def root(self):
+        return six.text_type(self)
 
     _interesting_categories = 'gender number case'.split()
 
@@ -48,11 +53,14 @@ class Adjective(Word):
 
 
 class SoftAdjective(Adjective):
-    def __init__(self, word):
-        if word.endswith('í'):
-            self.root = word[:-1]
+    __slots__ = ()
+
+    @property
+    def root(self):
+        if self.endswith('í'):
+            return self[:-1]
         else:
-            self.root = word
+            return six.text_type(self)
 
     endings_ma = 'í,ího,ímu,ího,í,ím,ím,í,ích,ím,í,í,ích,ími'.split(',')
     endings_mi = 'í,ího,ímu,í,í,ím,ím,í,ích,ím,í,í,ích,ími'.split(',')
@@ -61,11 +69,14 @@ class SoftAdjective(Adjective):
 
 
 class HardAdjective(Adjective):
-    def __init__(self, word):
-        if any(word.endswith(x) for x in 'ýáé'):
-            self.root = word[:-1]
+    __slots__ = ()
+
+    @property
+    def root(self):
+        if any(self.endswith(x) for x in 'ýáé'):
+            return self[:-1]
         else:
-            self.root = word
+            return six.text_type(self)
 
     endings_ma = 'ý,ého,ému,ého,ý,ém,ým,í,ých,ým,é,í,ých,ými'.split(',')
     endings_mi = 'ý,ého,ému,ý,ý,ém,ým,é,ých,ým,é,é,ých,ými'.split(',')
@@ -75,6 +86,5 @@ class HardAdjective(Adjective):
 formatter = Formatter('cs', Word)
 
 
-class Template(six.text_type):
-    def format(self, *args, **kwargs):
-        return formatter.format(self, *args, **kwargs)
+class Template(BaseTemplate):
+    formatter = formatter
@@ -1,11 +1,11 @@
 from __future__ import print_function, unicode_literals
 
-import six
-
-from forrin.template import Formatter, BaseWord
+from forrin.template import Formatter, BaseWord, BaseTemplate
 
 
 class Word(BaseWord):
+    __slots__ = ()
+
     @property
     def begins_with_vowel(self):
         return self and self[0].lower() in 'aeiou'
@@ -14,6 +14,7 @@ class Word(BaseWord):
 @Word.add_to_dictionary('a')
 @Word.add_to_dictionary('an')
 class IndefiniteArticle(Word):
+    __slots__ = ()
     interesting_categories = ['begins_with_vowel']
 
     def inflect(self, begins_with_vowel=None, **kwargs):
@@ -27,6 +28,5 @@ class IndefiniteArticle(Word):
 formatter = Formatter('en', Word)
 
 
-class Template(six.text_type):
-    def format(self, *args, **kwargs):
-        return formatter.format(self, *args, **kwargs)
+class Template(BaseTemplate):
+    formatter = formatter
@@ -1,9 +1,10 @@
 from __future__ import print_function, unicode_literals
 
+import re
 import ast
+import bisect
 import itertools
 import functools
-from six import StringIO
 
 import polib
 
@@ -39,7 +40,20 @@ def extract_python(filename, fileobj=None, keywords=['_'], **kwargs):
 babel_python = babel_wrapper(extract_python)
 
 
-def extract_from_string(string, filename, keywords=['_'], **kwargs):
+def extract_from_string(string, filename, keywords=['_'], method='ast',
+        **kwargs):
+    """Yield messages from Python source code
+
+    Sources without anything that looks like a call of one of the keywords
+    are skipped without parsing them.
+
+    With method='ast' (the default), the whole source is parsed.
+    With method='tokenize', see extract_from_tokens.
+    """
+    if not may_contain_messages(string, keywords):
+        return iter(())
+    if method == 'tokenize':
+        return extract_from_tokens(string, filename, keywords)
     tree = compile(
             string,
             filename=filename,
@@ -50,45 +64,190 @@ def extract_from_string(string, filename, keywords=['_'], **kwargs):
     return from_ast(tree, filename, keywords)
 
 
+def may_contain_messages(string, keywords=['_']):
+    """Quickly check if Python source may contain calls of the keywords
+
+    If this returns false, there are no calls like `keyword(...)` or
+    `obj.keyword(...)` in the source.
+    """
+    keywords = tuple(keywords)
+    try:
+        pattern = _call_patterns[keywords]
+    except KeyError:
+        pattern = _call_patterns[keywords] = re.compile(
+            r'(?<!\w)(?:%s)[\s\\]*\(' % '|'.join(
+                re.escape(k) for k in keywords),
+            re.UNICODE)
+    return bool(pattern.search(string))
+
+_call_patterns = {}
+
+
+def extract_from_tokens(string, filename, keywords=['_']):
+    """Yield messages from Python source code, without parsing all of it
+
+    Calls of the keywords are found by a simple tokenizer that only knows
+    about string literals, comments and brackets, and only the calls
+    themselves are parsed. The source doesn't need to be a complete module:
+    fragments like "for x in _('a', 'b', n=2):" work too.
+
+    Format flags are guessed from the text just around each call.
+    Calls inside f-strings are not found.
+    """
+    line_starts = [0] + [m.end() for m in re.finditer('\n', string)]
+    pattern = _token_patterns(keywords)[0]
+    pos = 0
+    while True:
+        match = pattern.search(string, pos)
+        if match is None:
+            return
+        pos = match.end()
+        if match.lastgroup != 'call':
+            continue
+        start = match.start()
+        end = _call_end(string, pos - 1, keywords)
+        if end is None:
+            continue
+        try:
+            tree = compile(string[start:end], filename, 'eval',
+                ast.PyCF_ONLY_AST, True)
+        except SyntaxError:
+            # Not a call after all (e.g. a function definition)
+            continue
+        ast.increment_lineno(tree, bisect.bisect_right(line_starts, start) - 1)
+        flags = []
+        if string[max(0, start - 80):start].rstrip().endswith('%'):
+            flags.append('python-format')
+        after = _after_call_pattern.match(string, end)
+        if after and after.group(1) == '%':
+            flags.append('python-format')
+        elif after:
+            flags.append('python3-format')
+        for message in from_ast(tree.body, filename, keywords, flags):
+            yield message
+        pos = end
+
+
+def _call_end(string, pos, keywords):
+    """Return the index just after the bracket matching the one at pos
+
+    Returns None if there's no matching bracket.
+    """
+    pattern = _token_patterns(keywords)[1]
+    depth = 0
+    while True:
+        match = pattern.search(string, pos)
+        if match is None:
+            return None
+        pos = match.end()
+        if match.lastgroup == 'open':
+            depth += 1
+        elif match.lastgroup == 'close':
+            depth -= 1
+            if depth == 0:
+                return pos
+
+
+def _token_patterns(keywords):
+    """Return regexes for finding calls and matching brackets, respectively
+    """
+    keywords = tuple(keywords)
+    try:
+        return _token_pattern_cache[keywords]
+    except KeyError:
+        skip = r'(?P<skip>%s|#[^\n]*)' % _string_literal
+        call = r'(?P<call>(?<!\w)(?:%s)[\s\\]*\()' % '|'.join(
+            re.escape(k) for k in keywords)
+        patterns = _token_pattern_cache[keywords] = (
+            re.compile(skip + '|' + call, re.UNICODE),
+            re.compile(skip + r'|(?P<open>[(\[{])|(?P<close>[)\]}])',
+                re.UNICODE),
+        )
+        return patterns
+
+_token_pattern_cache = {}
+
+# Python string literals, including triple-quoted and prefixed ones
+_string_literal = (
+    r"[rRbBuUfF]{0,3}(?:"
+    r"'''(?:[^\\']|\\[\s\S]|'(?!''))*'''|"
+    r'"""(?:[^\\"]|\\[\s\S]|"(?!""))*"""|'
+    r"'(?:[^\\'\n]|\\[\s\S])*'|"
+    r'"(?:[^\\"\n]|\\[\s\S])*")'
+)
+
+_after_call_pattern = re.compile(r'\s*(?:(%)(?!=)|\.\s*format\b)')
+
+
 def from_ast(node, filename, keywords, flags=[]):
-    if isinstance(node, ast.Call):
-        funcname = get_funcname(node.func)
-        if funcname in keywords:
-            params = {}
-            for name, param in itertools.chain(
-                    zip(_args, node.args),
-                    ((k.arg, k.value) for k in node.keywords),
-                ):
-                if isinstance(param, ast.Str):
-                    params[name] = param
-                else:
-                    # not a literal string: we don't care about it,
-                    # but still want to know if it's there
-                    params[name] = None
-            message = getstring(params.get('message'))
-            context = getstring(params.get('context'))
-            comment = getstring(params.get('comment'))
-            if message:
-                if context:
-                    message = context + '|' + message
-                message = polib.POEntry(
-                        msgid=message,
-                        occurrences=[(filename, node.lineno)],
-                    )
-                if 'plural' in params:
-                    message.msgid_plural = getstring(params.get('plural'))
-                if comment:
-                    message.comment = comment
-                message.flags = flags
+    """Yield messages from an AST node and all its descendants
+
+    The tree is walked with an explicit stack rather than recursively,
+    so deeply nested code doesn't hit the recursion limit.
+    """
+    stack = [(node, flags)]
+    pop = stack.pop
+    push = stack.append
+    while stack:
+        node, flags = pop()
+        if isinstance(node, ast.Call):
+            message = from_call(node, filename, keywords, flags)
+            if message is not None:
                 yield message
-    child_flags = []
-    if isinstance(node, ast.BinOp) and isinstance(node.op, ast.Mod):
-        child_flags.append('python-format')
-    if isinstance(node, ast.Attribute) and node.attr == 'format':
-        child_flags.append('python3-format')
-    for child in ast.iter_child_nodes(node):
-        for result in from_ast(child, filename, keywords, child_flags):
-            yield result
+        if isinstance(node, ast.BinOp) and isinstance(node.op, ast.Mod):
+            child_flags = _python_format_flags
+        elif isinstance(node, ast.Attribute) and node.attr == 'format':
+            child_flags = _python3_format_flags
+        else:
+            child_flags = _no_flags
+        # Push children in reverse, so they are popped in order
+        for field in reversed(node._fields):
+            child = getattr(node, field, None)
+            if isinstance(child, ast.AST):
+                push((child, child_flags))
+            elif isinstance(child, list):
+                for item in reversed(child):
+                    if isinstance(item, ast.AST):
+                        push((item, child_flags))
+
+_no_flags = ()
+_python_format_flags = ('python-format', )
+_python3_format_flags = ('python3-format', )
+
+
+def from_call(node, filename, keywords, flags):
+    """Return the message from an ast.Call node, or None if there's none"""
+    funcname = get_funcname(node.func)
+    if funcname not in keywords:
+        return None
+    params = {}
+    for name, param in itertools.chain(
+            zip(_args, node.args),
+            ((k.arg, k.value) for k in node.keywords),
+        ):
+        if isinstance(param, ast.Str):
+            params[name] = param
+        else:
+            # not a literal string: we don't care about it,
+            # but still want to know if it's there
+            params[name] = None
+    message = getstring(params.get('message'))
+    context = getstring(params.get('context'))
+    comment = getstring(params.get('comment'))
+    if not message:
+        return None
+    if context:
+        message = context + '|' + message
+    message = polib.POEntry(
+            msgid=message,
+            occurrences=[(filename, node.lineno)],
+        )
+    if 'plural' in params:
+        message.msgid_plural = getstring(params.get('plural'))
+    if comment:
+        message.comment = comment
+    message.flags = list(flags)
+    return message
 
 
 def get_funcname(node):
@@ -112,37 +271,54 @@ def getstring(maybenode):
 
 
 try:
-    from mako.template import Template
+    from mako.lexer import Lexer as MakoLexer
+    from mako import parsetree
 except ImportError:
     pass
 else:
     def extract_mako(filename, fileobj=None, keywords=['_'], **kwargs):
         if fileobj is None:
             fileobj = open(filename)
-        template = Template(
-                fileobj.read(),
+        return extract_mako_from_string(fileobj.read(), filename, keywords)
+
+    def extract_mako_from_string(string, filename, keywords=['_']):
+        """Yield messages from a Mako template
+
+        The template is only lexed, not compiled to Python: the Python code
+        in it (expressions, control lines, code blocks and tag attributes)
+        is passed to extract_from_tokens.
+        """
+        if not may_contain_messages(string, keywords):
+            return
+        tree = MakoLexer(
+                string,
+                filename=filename,
                 input_encoding='utf-8',
-                output_encoding='utf-8',
-            )
-        # We need line numbers that correspond to the mako file.
-        # Mako does this by including "# SOURCE LINE xxx" comments in the file;
-        # use these to build a line number map
-        linenomap = [0]
-        lineno = 0
-        for line in template.code.splitlines():
-            emptystring, sep, number = line.strip().partition("# SOURCE LINE ")
-            if not emptystring and sep:
-                try:
-                    lineno = int(number)
-                except ValueError:
-                    pass
-            linenomap.append(lineno)
-        # Finally, do the actual extracting
-        fileobj = StringIO(template.code)
-        messages = extract_python(filename, fileobj, keywords, **kwargs)
-        for message in messages:
-            message.occurrences = [
-                    (o[0], linenomap[o[1]]) for o in message.occurrences]
-            yield message
+            ).parse()
+        stack = [tree]
+        while stack:
+            node = stack.pop()
+            for code in _mako_code(node):
+                messages = extract_from_tokens(code, filename, keywords)
+                for message in messages:
+                    message.occurrences = [(f, lineno + node.lineno - 1)
+                        for f, lineno in message.occurrences]
+                    yield message
+            if not isinstance(node, parsetree.ControlLine):
+                # Nodes after a control line are its children, but they
+                # are also children of the control line's parent
+                stack.extend(reversed(node.get_children()))
+
+    def _mako_code(node):
+        """Return a list of Python code fragments in a Mako parse tree node
+        """
+        if isinstance(node, (parsetree.Expression, parsetree.Code)):
+            return [node.text]
+        elif isinstance(node, parsetree.ControlLine):
+            return [] if node.isend else [node.text]
+        elif isinstance(node, parsetree.Tag):
+            return list(node.attributes.values())
+        else:
+            return []
 
     babel_mako = babel_wrapper(extract_mako)
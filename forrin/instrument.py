@@ -0,0 +1,111 @@
+"""Opt-in instrumentation of the translate-and-format pipeline
+
+A Recorder collects counts and cumulative times of named events.
+Give one to a translator (BaseTranslator(recorder=...)) to record:
+
+- translate: calls of the translator (timed)
+- backend.hit, backend.fallback, backend.miss: backend lookups that were
+  found in a language, passed to a fallback language, or fell through to
+  the source text
+- backend.build: rebuilds of a language catalog (timed)
+- backend.load: loads of a catalog shard into memory (timed)
+- template.create: @-messages turned into Templates
+- template.compile, template.format: compiling and formatting templates
+  created by the translator (timed)
+- word.create, word.inflect: words created and inflected while formatting
+
+Without a recorder, nothing is recorded, and the only cost is checking for
+its presence.
+
+A MessageProfile records which messages a translator is asked for
+(BaseTranslator(profile=...)). Saved to a file, it can be used to preload
+the hot messages when a process starts:
+
+    translator.preload(load_profile(filename))
+"""
+
+from __future__ import print_function, unicode_literals
+
+import io
+import json
+import time
+
+try:
+    clock = time.perf_counter
+except AttributeError:
+    # Python 2
+    clock = time.time
+
+
+class Recorder(object):
+    """Collects counts and cumulative times of named events"""
+    clock = staticmethod(clock)
+
+    def __init__(self):
+        self.counts = {}
+        self.times = {}
+
+    def count(self, name, n=1):
+        """Count n events called name"""
+        self.counts[name] = self.counts.get(name, 0) + n
+
+    def add_time(self, name, start):
+        """Count an event called name, which started at clock() time start
+        """
+        self.times[name] = self.times.get(name, 0) + (self.clock() - start)
+        self.count(name)
+
+    def snapshot(self):
+        """Return the recorded counts and times, as a dict"""
+        return dict(counts=dict(self.counts), times=dict(self.times))
+
+    def reset(self):
+        """Forget everything recorded so far"""
+        self.counts.clear()
+        self.times.clear()
+
+
+class MessageProfile(object):
+    """Counts how often messages are requested
+
+    Only every interval-th request is counted, to keep the overhead low.
+    Messages are identified by (message, plural, context) tuples.
+    """
+    def __init__(self, interval=1):
+        self.interval = interval
+        self.counts = {}
+        self._countdown = interval
+
+    def record(self, message, plural=None, context=None):
+        """Record a request for a message (if it's sampled)"""
+        self._countdown -= 1
+        if self._countdown:
+            return
+        self._countdown = self.interval
+        key = message, plural, context
+        self.counts[key] = self.counts.get(key, 0) + 1
+
+    def hot_messages(self, limit=None):
+        """Return the recorded messages, most requested first"""
+        # Plurals and contexts may be None, which doesn't compare to strings
+        messages = sorted(self.counts, key=lambda k: (
+            -self.counts[k], tuple(part or '' for part in k)))
+        return messages[:limit]
+
+    def save(self, filename, limit=None):
+        """Save the hot messages, for load_profile"""
+        data = dict(version=1, messages=[
+            [message, plural, context, self.counts[message, plural, context]]
+            for message, plural, context in self.hot_messages(limit)])
+        with io.open(filename, 'w', encoding='utf-8') as fileobj:
+            fileobj.write(json.dumps(data, indent=1, ensure_ascii=False))
+
+
+def load_profile(filename):
+    """Return a list of (message, plural, context) saved by MessageProfile"""
+    with io.open(filename, encoding='utf-8') as fileobj:
+        data = json.load(fileobj)
+    if data.get('version') != 1:
+        raise ValueError('Unknown profile version in %s' % filename)
+    return [(message, plural, context)
+        for message, plural, context, count in data['messages']]
@@ -1,11 +1,45 @@
 from __future__ import print_function, unicode_literals
 
-from polib import POFile, POEntry, pofile
+import io
+import re
+import json
+import itertools
+import tempfile
+from array import array
+from collections import OrderedDict
+
+import six
+from polib import POFile, POEntry, pofile, detect_encoding, unescape
 from datetime import datetime
 
 import forrin
 
 
+def pot_metadata(
+        project_name=None,
+        project_version=None,
+        project_i18n_contact=None,
+        **metadata
+    ):
+    """Return metadata for a new .pot file"""
+    if project_name:
+        if project_version:
+            metadata.setdefault('Project-Id-Version',
+                "%s %s" % (project_name, project_version))
+        else:
+            metadata.setdefault('Project-Id', project_name)
+    if project_i18n_contact:
+        metadata.setdefault('Report-Msgid-Bugs-To', project_i18n_contact)
+    metadata.setdefault('POT-Creation-Date', datetime.now().isoformat())
+    metadata.setdefault('Last-Translator', 'FULL NAME <EMAIL@ADDRESS>')
+    metadata.setdefault('Language-Team', 'LANGUAGE <LL@li.org>')
+    metadata.setdefault('MIME-Version', '1.0')
+    metadata.setdefault('Content-Type', 'text/plain; charset=utf-8')
+    metadata.setdefault('Content-Transfer-Encoding', '8bit')
+    metadata.setdefault('Generated-By', 'forrin %s' % forrin.__version__)
+    return metadata
+
+
 class POTFile(POFile):
     def __init__(self,
             fpath=None,
@@ -17,22 +51,8 @@ class POTFile(POFile):
         ):
         super(POTFile, self).__init__(fpath, wrapwidth)
         self._msg_dict = dict()
-        if project_name:
-            if project_version:
-                metadata.setdefault('Project-Id-Version',
-                    "%s %s" % (project_name, project_version))
-            else:
-                metadata.setdefault('Project-Id', project_name)
-        if project_i18n_contact:
-            metadata.setdefault('Report-Msgid-Bugs-To', project_i18n_contact)
-        metadata.setdefault('POT-Creation-Date', datetime.now().isoformat())
-        metadata.setdefault('Last-Translator', 'FULL NAME <EMAIL@ADDRESS>')
-        metadata.setdefault('Language-Team', 'LANGUAGE <LL@li.org>')
-        metadata.setdefault('MIME-Version', '1.0')
-        metadata.setdefault('Content-Type', 'text/plain; charset=utf-8')
-        metadata.setdefault('Content-Transfer-Encoding', '8bit')
-        metadata.setdefault('Generated-By', 'forrin %s' % forrin.__version__)
-        self.metadata = metadata
+        self.metadata = pot_metadata(project_name, project_version,
+            project_i18n_contact, **metadata)
 
     def add(self, message):
         merge_key = message.msgid, message.msgid_plural
@@ -50,3 +70,184 @@ class POTFile(POFile):
     def add_messages(self, messages):
         for message in messages:
             self.add(message)
+
+
+class MergeIndex(object):
+    """A .pot catalog prepared for merging into many .po files
+
+    merge(po) works like polib's po.merge(pot), but the .pot is only
+    indexed once, and each .po file is indexed by a single dict rather
+    than searched for each message.
+    """
+    def __init__(self, pot):
+        self.entries = [(entry.msgid_with_context, entry) for entry in pot]
+        self.keys = frozenset(key for key, entry in self.entries)
+
+    def merge(self, po):
+        """Merge the .pot into the given POFile, in place"""
+        existing = dict((entry.msgid_with_context, entry) for entry in po)
+        for key, reference in self.entries:
+            entry = existing.get(key)
+            if entry is None:
+                entry = POEntry()
+                po.append(entry)
+            entry.merge(reference)
+        # Entries no longer in the .pot are obsolete
+        keys = self.keys
+        for entry in po:
+            if entry.msgid_with_context not in keys:
+                entry.obsolete = True
+
+
+class POTWriter(object):
+    """Writes a .pot file without keeping all the messages in memory
+
+    Messages are merged like in POTFile.add. Their occurrences and comments
+    are spooled to a temporary file, and only an index of where they are
+    is kept in memory, so memory use is proportional to the number of
+    unique messages.
+
+    Call save() to write the .pot file, and close() when done.
+    """
+    def __init__(self,
+            wrapwidth=78,
+            project_name=None,
+            project_version=None,
+            project_i18n_contact=None,
+            **metadata
+        ):
+        self.wrapwidth = wrapwidth
+        self.metadata = pot_metadata(project_name, project_version,
+            project_i18n_contact, **metadata)
+        self._spool = tempfile.TemporaryFile()
+        # (msgid, msgid_plural) -> (flags, offsets of spooled records)
+        self._index = OrderedDict()
+
+    def __len__(self):
+        return len(self._index)
+
+    def add(self, message):
+        merge_key = message.msgid, message.msgid_plural
+        offset = self._spool.tell()
+        record = json.dumps([message.occurrences, message.comment])
+        self._spool.write(record.encode('utf-8') + b'\n')
+        try:
+            flags, offsets = self._index[merge_key]
+        except KeyError:
+            self._index[merge_key] = message.flags, array(str('l'), [offset])
+        else:
+            offsets.append(offset)
+
+    def add_messages(self, messages):
+        for message in messages:
+            self.add(message)
+
+    def entries(self):
+        """Yield the merged POEntries, one at a time"""
+        spool = self._spool
+        end = spool.tell()
+        try:
+            for (msgid, msgid_plural), (flags, offsets) in self._index.items():
+                entry = POEntry(msgid=msgid, msgid_plural=msgid_plural,
+                    flags=flags)
+                for offset in offsets:
+                    spool.seek(offset)
+                    occurrences, comment = json.loads(
+                        spool.readline().decode('utf-8'))
+                    entry.occurrences += [tuple(o) for o in occurrences]
+                    if entry.comment and comment:
+                        entry.comment += '\n\n'
+                    entry.comment += comment
+                yield entry
+        finally:
+            spool.seek(end)
+
+    def save(self, fpath):
+        """Write the .pot file"""
+        header = POFile(wrapwidth=self.wrapwidth)
+        header.metadata = self.metadata
+        with io.open(fpath, 'w', encoding=header.encoding) as fileobj:
+            fileobj.write(six.text_type(header))
+            for entry in self.entries():
+                fileobj.write('\n')
+                fileobj.write(entry.__unicode__(self.wrapwidth))
+
+    def close(self):
+        self._spool.close()
+
+
+def scan_catalog(fpath):
+    """Yield (msgid_with_context, translated) for entries of a .po/.pot file
+
+    A cheap streaming alternative to polib.pofile, for when only the keys
+    of messages and whether they are translated are needed.
+    The header and obsolete entries are skipped. translated is true for
+    entries whose POEntry.translated() would be true.
+    """
+    with io.open(fpath, encoding=detect_encoding(fpath)) as fileobj:
+        fields = {}
+        fuzzy = obsolete = has_msgstr = False
+        current = None
+        for line in itertools.chain(fileobj, ['']):
+            line = line.strip()
+            if line.startswith('"'):
+                # continuation of the current field
+                if current is not None:
+                    fields[current] += unescape(line[1:-1])
+                continue
+            match = None
+            if not line:
+                end = True
+            elif line.startswith('#~'):
+                end = bool(fields)
+            elif line.startswith('#'):
+                end = bool(fields) or obsolete
+            else:
+                match = _keyword_line.match(line)
+                if match is None:
+                    continue
+                end = obsolete or (has_msgstr and
+                    match.group(1) in ('msgctxt', 'msgid'))
+            if end:
+                if not obsolete:
+                    result = _scanned_entry(fields, fuzzy)
+                    if result is not None:
+                        yield result
+                fields = {}
+                fuzzy = obsolete = has_msgstr = False
+                current = None
+            if match is not None:
+                current = match.group(1)
+                fields[current] = unescape(match.group(2))
+                if current.startswith('msgstr'):
+                    has_msgstr = True
+            elif line.startswith('#~'):
+                obsolete = True
+            elif line.startswith('#,'):
+                if 'fuzzy' in [f.strip() for f in line[2:].split(',')]:
+                    fuzzy = True
+
+_keyword_line = re.compile(
+    r'(msgctxt|msgid_plural|msgid|msgstr(?:\[\d+\])?)\s*"(.*)"$')
+
+
+def _scanned_entry(fields, fuzzy):
+    """Return (msgid_with_context, translated) for scan_catalog, or None"""
+    msgid = fields.get('msgid')
+    msgctxt = fields.get('msgctxt')
+    if msgid is None or (msgid == '' and msgctxt is None):
+        # not a message, or the header
+        return None
+    if msgctxt:
+        key = '%s\x04%s' % (msgctxt, msgid)
+    else:
+        key = msgid
+    if fuzzy:
+        translated = False
+    elif fields.get('msgstr'):
+        translated = True
+    else:
+        plurals = [value for name, value in fields.items()
+            if name.startswith('msgstr[')]
+        translated = bool(plurals) and all(plurals)
+    return key, translated
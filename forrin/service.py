@@ -0,0 +1,232 @@
+"""A translation service, for sharing compiled catalogs between processes
+
+A TranslationServer holds the catalogs compiled by ForrinTools' compile
+action, and answers lookups over a Unix domain socket. Processes use it
+through a ServiceBackend:
+
+    translations = ServiceBackend(socket_path, ['cs', 'en'])
+    _ = Translator(languages=['cs', 'en'], translations=translations)
+
+The protocol is line-delimited JSON. Each request is an object with
+"languages" (a list of language codes, in order of preference) and
+"messages" (a list of [msgid], [msgid, plural] or [msgid, plural, n]
+lists).
+The response is an object with "translations" (a list of translations,
+one per message), or with "error".
+Messages with one or three items are translated to strings. For
+[msgid, plural], the translation is a list of [plural_forms, forms] pairs,
+one for each language that has the message: plural_forms is the
+language's Plural-Forms header, and forms maps plural numbers to
+translations. This lets clients choose the plural form for any n locally.
+Several requests can be sent before reading the responses; they are
+answered in order.
+"""
+
+from __future__ import print_function, unicode_literals
+
+import os
+import json
+import socket
+import threading
+
+import six
+from six.moves import socketserver, zip
+
+import forrin.backend
+
+
+class TranslationServer(socketserver.ThreadingMixIn,
+        socketserver.UnixStreamServer):
+    """Serves translations from a precompiled catalog database
+
+    domain and directory are as for SQLiteBackend: the database is
+    <directory>/<domain>.forrin-db, unless another file is given as
+    store_path.
+    """
+    daemon_threads = True
+
+    def __init__(self, socket_path, directory, domain, store_path=None):
+        self.directory = directory
+        self.domain = domain
+        if store_path is None:
+            store_path = os.path.join(directory, '%s.forrin-db' % domain)
+        self.store = forrin.backend.CatalogStore(store_path, readonly=True)
+        self.lock = threading.Lock()
+        self.backends = {}
+        socketserver.UnixStreamServer.__init__(
+            self, socket_path, TranslationRequestHandler)
+
+    def translate(self, languages, messages):
+        """Return a list of translations of the given messages
+
+        messages is a list of [msgid], [msgid, plural] or [msgid, plural, n]
+        lists; see the module docstring.
+        """
+        languages = tuple(languages)
+        with self.lock:
+            try:
+                backend = self.backends[languages]
+            except KeyError:
+                backend = self.backends[languages] = (
+                    forrin.backend.SQLiteBackend(
+                        self.domain, self.directory, list(languages),
+                        store=self.store, precompiled=True))
+            result = []
+            for message in messages:
+                if len(message) == 1:
+                    result.append(backend.gettext(message[0]))
+                elif len(message) == 2:
+                    result.append([[plural_forms, dict(
+                            (six.text_type(number), translation)
+                            for number, translation in forms.items())]
+                        for plural_forms, forms
+                        in backend.plural_entries(message[0])])
+                else:
+                    msgid, plural, n = message
+                    result.append(backend.ngettext(msgid, plural, n))
+            return result
+
+    def server_close(self):
+        socketserver.UnixStreamServer.server_close(self)
+        self.store.close()
+
+
+class TranslationRequestHandler(socketserver.StreamRequestHandler):
+    """Handles a connection to a TranslationServer"""
+    def handle(self):
+        for line in self.rfile:
+            try:
+                request = json.loads(line.decode('utf-8'))
+                response = dict(translations=self.server.translate(
+                    request['languages'], request['messages']))
+            except Exception as e:
+                # Report the problem to the client, and keep serving
+                response = dict(error='%s: %s' % (type(e).__name__, e))
+            self.wfile.write(json.dumps(response).encode('utf-8') + b'\n')
+            self.wfile.flush()
+
+
+class ServiceBackend(object):
+    """Translations from a TranslationServer
+
+    Pass an instance as translations to a BaseTranslator.
+    Results are cached locally. Use prefetch to look up many messages in
+    a few round trips.
+    All plural forms of a message are fetched at once, so ngettext only
+    needs a round trip for the first n.
+    The backend can be shared by threads; lookups that need the server
+    take turns.
+    """
+    def __init__(self, socket_path, languages, batch_size=500):
+        self.languages = list(languages)
+        self.batch_size = batch_size
+        self.cache = {}
+        self.lock = threading.Lock()
+        # Plural-Forms header -> plural function
+        self._plurals = {}
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.socket.connect(socket_path)
+        self._rfile = self.socket.makefile('rb')
+        self._wfile = self.socket.makefile('wb')
+
+    def prefetch(self, messages):
+        """Look up the given messages, and cache the results
+
+        messages is an iterable of (msgid,) or (msgid, plural) tuples;
+        (msgid, plural, n) tuples are also accepted, and fetch all plural
+        forms of the message.
+        Messages are sent in batches of batch_size. The batches are written
+        by a separate thread while responses are read, so neither side
+        waits for the other when the socket buffers fill up.
+        """
+        cache = self.cache
+        messages = set(tuple(m[:2]) if len(m) == 3 else tuple(m)
+            for m in messages)
+        errors = []
+        with self.lock:
+            messages = [m for m in messages if m not in cache]
+            batches = [messages[i:i + self.batch_size]
+                for i in range(0, len(messages), self.batch_size)]
+            write_errors = []
+            writer = threading.Thread(
+                target=self._write_batches, args=(batches, write_errors))
+            writer.daemon = True
+            writer.start()
+            # Read all responses, even after an error, to keep them in sync
+            for batch in batches:
+                line = self._rfile.readline()
+                if not line:
+                    writer.join()
+                    raise RuntimeError(
+                        'Translation service closed the connection: %s' % (
+                            '; '.join(str(e) for e in write_errors)))
+                response = json.loads(line.decode('utf-8'))
+                if 'error' in response:
+                    errors.append(response['error'])
+                else:
+                    for message, translation in zip(
+                            batch, response['translations']):
+                        if len(message) == 2:
+                            translation = [
+                                (self._plural(plural_forms), dict(
+                                    (int(number), text)
+                                    for number, text in forms.items()))
+                                for plural_forms, forms in translation]
+                        cache[message] = translation
+            writer.join()
+        if errors:
+            raise RuntimeError(
+                'Translation service error: %s' % '; '.join(errors))
+
+    def _write_batches(self, batches, errors):
+        """Send requests for the given batches (in prefetch's writer thread)
+        """
+        try:
+            for batch in batches:
+                request = dict(languages=self.languages, messages=batch)
+                self._wfile.write(json.dumps(request).encode('utf-8') + b'\n')
+            self._wfile.flush()
+        except (IOError, OSError) as e:
+            errors.append(e)
+
+    def preload(self, msgids):
+        """Look up the given messages (without plurals), see prefetch"""
+        self.prefetch((msgid, ) for msgid in msgids)
+
+    def gettext(self, msgid):
+        key = msgid,
+        try:
+            return self.cache[key]
+        except KeyError:
+            self.prefetch([key])
+            return self.cache[key]
+
+    def ngettext(self, msgid, plural, n):
+        key = msgid, plural
+        try:
+            entries = self.cache[key]
+        except KeyError:
+            self.prefetch([key])
+            entries = self.cache[key]
+        for plural_function, forms in entries:
+            number = plural_function(n)
+            if number in forms:
+                return forms[number]
+        if n == 1:
+            return msgid
+        else:
+            return plural
+
+    def _plural(self, plural_forms):
+        """Return the plural function for a Plural-Forms header"""
+        try:
+            return self._plurals[plural_forms]
+        except KeyError:
+            function = forrin.backend.parse_plural_forms(plural_forms)[1]
+            self._plurals[plural_forms] = function
+            return function
+
+    def close(self):
+        self._rfile.close()
+        self._wfile.close()
+        self.socket.close()
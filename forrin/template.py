@@ -39,6 +39,14 @@ used as a bare value, all "interesting" categories are used.
 The field name may begin with '=', in which case it is literal. For example,
 in English, "{=a:*obj} {obj}" will provide a word with its indefinite article.
 
+Fields without a conversion or format specification don't need any grammar;
+they are formatted as with str.format, without creating a Word. Templates
+made only of such fields are formatted using str.format directly.
+
+Formatters compile each format string once, and can format a template for
+many rows of arguments at once with format_many(), inflecting each distinct
+word only once.
+
 """
 
 from __future__ import print_function, unicode_literals
@@ -47,55 +55,211 @@ import string
 
 import six
 
+try:
+    from collections.abc import Mapping
+except ImportError:
+    from collections import Mapping
+
 
 class Formatter(string.Formatter):
     def __init__(self, lang, word_class, shortcuts={}):
         self.lang = lang
         self.word_class = word_class
         self.shortcuts = shortcuts
-
-    def vformat(self, format_string, args, kwargs):
-        used_args = set()
-        result = self._vformat(format_string, args, kwargs, used_args, 2)
-        self.check_unused_args(used_args, args, kwargs)
+        self._programs = {}
+        self._specs = {}
+        self._categories = {}
+
+    def compile(self, format_string, recorder=None):
+        """Return the FormatProgram for format_string
+
+        Programs are cached, so each format string is only parsed once.
+        If a forrin.instrument.Recorder is given, compilation is recorded.
+        """
+        try:
+            return self._programs[format_string]
+        except KeyError:
+            if recorder is not None:
+                start = recorder.clock()
+            program = self._programs[format_string] = FormatProgram(
+                self, format_string)
+            if recorder is not None:
+                recorder.add_time('template.compile', start)
+            return program
+
+    def snapshot(self, format_strings):
+        """Return the compiled state for the given format strings, for restore
+
+        The state is picklable. It includes the programs of the format
+        strings, all compiled specs, and the variants of this formatter's
+        word classes created so far.
+        """
+        return dict(
+            programs=dict(
+                (six.text_type(format_string), self.compile(format_string))
+                for format_string in format_strings),
+            specs=dict(self._specs),
+            word_variants=[(base, dict(props))
+                for base, props in _word_variants
+                if issubclass(base, self.word_class)],
+        )
+
+    def restore(self, state):
+        """Add compiled programs, specs and word variants from snapshot"""
+        for format_string, program in state['programs'].items():
+            self._programs.setdefault(format_string, program)
+        for spec, compiled in state['specs'].items():
+            self._specs.setdefault(spec, compiled)
+        for base, props in state['word_variants']:
+            base.with_props(**props)
+
+    def vformat(self, format_string, args, kwargs, recorder=None):
+        if recorder is not None:
+            start = recorder.clock()
+        if self.compile(format_string, recorder).plain:
+            result = six.text_type.format(format_string, *args, **kwargs)
+        else:
+            used_args = set()
+            result = self._vformat(format_string, args, kwargs, used_args, 2,
+                recorder=recorder)
+            self.check_unused_args(used_args, args, kwargs)
+        if recorder is not None:
+            recorder.add_time('template.format', start)
         return result
 
+    def format_many(self, format_string, rows, recorder=None):
+        """Format format_string with each of the given rows of arguments
+
+        Each row is either a mapping of keyword arguments, or a sequence of
+        positional arguments. Returns an iterator of the results.
+
+        Each distinct combination of a word, its conversion and format spec,
+        and the words the spec refers to (which determine the categories
+        it is inflected to) is only inflected once.
+
+        If a forrin.instrument.Recorder is given, formatting is recorded.
+        """
+        plain = self.compile(format_string, recorder).plain
+        memo = {}
+        for row in rows:
+            if recorder is not None:
+                start = recorder.clock()
+            if isinstance(row, Mapping):
+                args, kwargs = (), row
+            else:
+                args, kwargs = row, {}
+            if plain:
+                result = six.text_type.format(format_string, *args, **kwargs)
+            else:
+                used_args = set()
+                result = self._vformat(format_string, args, kwargs,
+                    used_args, 2, memo, recorder)
+                self.check_unused_args(used_args, args, kwargs)
+            if recorder is not None:
+                recorder.add_time('template.format', start)
+            yield result
+
     def _vformat(self, format_string, args, kwargs, used_args,
-            recursion_depth):
+            recursion_depth, memo=None, recorder=None):
         """This function does the actual work of formatting.
 
-        Mostly reused from string.Formatter._vformat """
+        Mostly reused from string.Formatter._vformat, but works on the
+        compiled FormatProgram.
+
+        If memo is given, it is used to cache formatted fields.
+        If recorder is given, word creation and inflection is counted.
+        """
         if recursion_depth < 0:
             raise ValueError('Max string recursion exceeded')
         result = []
-        for literal_text, field_name, format_spec, conversion in \
-                self.parse(format_string):
+        for field in self.compile(format_string, recorder).fields:
 
             # output the literal text
-            if literal_text:
-                result.append(literal_text)
+            if field.literal_text:
+                result.append(field.literal_text)
 
             # if there's a field, output it
-            if field_name is not None:
+            if field.name is not None:
                 # this is some markup, find the object and do
                 #  the formatting
 
-                obj, arg_used = self.get_field(field_name, args, kwargs)
+                obj, arg_used = field.accessor.get(self, args, kwargs)
                 used_args.add(arg_used)
 
+                # fields that need no grammar are formatted as by str.format
+                if field.plain:
+                    result.append(format(obj, ''))
+                    continue
+
+                # look the field up in the memo, if possible
+                if memo is not None and field.references is not None:
+                    memo_key = self._memo_key(obj, field, args, kwargs)
+                    if memo_key in memo:
+                        result.append(memo[memo_key])
+                        continue
+                else:
+                    memo_key = None
+
                 # do any conversion on the resulting object
-                obj = self.convert_field(obj, conversion, args, kwargs)
+                spec = field.conversion_spec.resolve(self, None, args, kwargs)
+                word = self.word_class.create(obj, **spec)
 
                 # expand the format spec, if needed
-                format_spec = self._vformat(format_spec, args, kwargs,
-                                            used_args, recursion_depth - 1)
+                format_specs = field.format_specs
+                if format_specs is None:
+                    format_spec = self._vformat(field.format_spec, args,
+                        kwargs, used_args, recursion_depth - 1,
+                        recorder=recorder)
+                    format_specs = [self.compile_spec(spec)
+                        for spec in format_spec.split(':')]
 
                 # format the object and append to the result
-                result.append(self.format_field(
-                    obj, format_spec, args, kwargs))
+                for spec in format_specs:
+                    word = word.inflect(**spec.resolve(self, word, args,
+                        kwargs))
+                if recorder is not None:
+                    recorder.count('word.create')
+                    recorder.count('word.inflect', len(format_specs))
+                if memo_key is not None:
+                    memo[memo_key] = word
+                result.append(word)
 
         return ''.join(result)
 
+    def _memo_key(self, obj, field, args, kwargs):
+        """Return a key for caching a formatted field, or None
+
+        Only plain strings are cached: words may carry extra information.
+        """
+        values = [obj]
+        for accessor in field.references:
+            values.append(accessor.get(self, args, kwargs)[0])
+        for value in values:
+            if type(value) is not six.text_type:
+                return None
+        return field, tuple(values)
+
+    def compile_spec(self, spec):
+        """Return the CompiledSpec for a conversion or format spec part
+
+        Compiled specs are cached, so each spec is only parsed once.
+        """
+        try:
+            return self._specs[spec]
+        except KeyError:
+            compiled = self._specs[spec] = CompiledSpec(self, spec)
+            return compiled
+
+    def interesting_categories(self, word):
+        """Return the categories a bare *ref takes from the given word"""
+        word_class = type(word)
+        try:
+            return self._categories[word_class]
+        except KeyError:
+            categories = tuple(word_class.interesting_categories)
+            self._categories[word_class] = categories
+            return categories
+
     def get_field(self, field_name, args, kwargs):
         if field_name.startswith("="):
             return field_name[1:], None
@@ -116,35 +280,56 @@ class Formatter(string.Formatter):
     def parse_spec(self, word, spec, args, kwargs):
         if not spec:
             return {}
-        result = {}
-        for item in spec.split(','):
-            keys, sep, val = item.rpartition('=')
-            if keys:
-                keys = keys.split('=')
-            else:
-                keys = []
-            if val.startswith('*'):
-                val, a = self.get_field(val[1:], args, kwargs)
-                val = self.convert_field(val)
-                if not keys and word:
-                    keys = word.interesting_categories
-                for key in keys:
-                    result[key] = getattr(val, key)
-            elif keys:
-                for key in keys:
-                    result[key] = val
-            else:
-                result.update(self.shortcuts[val])
-        return result
+        return dict(self.compile_spec(spec).resolve(self, word, args, kwargs))
 
 
 class BaseWord(six.text_type):
+    """A word that can be inflected
+
+    Words don't have a __dict__: subclasses should set __slots__.
+    Grammatical properties given to the constructor become class attributes
+    of a variant subclass, shared by all words with the same properties
+    (see with_props).
+    """
+    __slots__ = ()
     interesting_categories = {}
     dictionary = {}
 
-    def __init__(self, word, **props):
-        for key, value in props.items():
-            setattr(self, key, value)
+    def __new__(cls, word='', **props):
+        if props:
+            cls = cls.with_props(**props)
+        return super(BaseWord, cls).__new__(cls, word)
+
+    def __reduce__(self):
+        cls = type(self)
+        return _make_word, (
+            cls.__dict__.get('_variant_base', cls),
+            six.text_type(self),
+            cls.__dict__.get('_variant_props', {}),
+        )
+
+    @classmethod
+    def with_props(cls, **props):
+        """Return a variant of this class with props as class attributes
+
+        Variants are cached, so all words with the same properties share one.
+        """
+        base = cls.__dict__.get('_variant_base', cls)
+        props = dict(cls.__dict__.get('_variant_props', {}), **props)
+        key = base, frozenset(props.items())
+        try:
+            return _word_variants[key]
+        except KeyError:
+            attrs = dict(props)
+            attrs.update(
+                __slots__=(),
+                __module__=base.__module__,
+                _variant_base=base,
+                _variant_props=props,
+            )
+            variant = type(base)(str(base.__name__), (base,), attrs)
+            _word_variants[key] = variant
+            return variant
 
     @classmethod
     def create(cls, word, **props):
@@ -178,6 +363,8 @@ class BaseWord(six.text_type):
 
 
 class BasePhrase(BaseWord):
+    __slots__ = ('words',)
+
     @classmethod
     def create(cls, words):
         words = tuple(words)
@@ -185,11 +372,205 @@ class BasePhrase(BaseWord):
         r.words = words
         return r
 
+    def __reduce__(self):
+        return _make_phrase, (type(self), self.words)
+
     def inflect(self, **kwargs):
         return ' '.join(w.inflect(**kwargs) for w in self.words)
 
 BaseWord.phrase = BasePhrase
 
+_word_variants = {}
+
+
+def _make_word(cls, word, props):
+    """Unpickle a BaseWord"""
+    return cls(word, **props)
+
+
+def _make_phrase(cls, words):
+    """Unpickle a BasePhrase"""
+    return cls.create(words)
+
+
+class FormatProgram(object):
+    """A format string parsed by a Formatter, ready to be formatted
+
+    fields is a list of Fields. plain is true if all fields are plain;
+    str.format can be used directly to format such programs.
+    """
+    def __init__(self, formatter, format_string):
+        self.fields = [Field(formatter, *parsed)
+            for parsed in formatter.parse(format_string)]
+        self.plain = all(field.plain for field in self.fields
+            if field.name is not None)
+
+
+class Field(object):
+    """A literal text and a replacement field of a FormatProgram
+
+    name is None if there is no replacement field after the literal text.
+    plain is true for fields that need no grammar: those without conversion
+    and format spec.
+
+    The conversion and each ':'-separated part of the format spec are
+    compiled to CompiledSpecs, conversion_spec and format_specs.
+    If the format spec contains nested fields, format_specs is None, and
+    format_spec must be expanded and compiled when formatting.
+
+    references lists Accessors of arguments the specs refer to with *ref,
+    or is None if it is not known in advance.
+    """
+    __slots__ = ('literal_text', 'name', 'accessor', 'plain', 'format_spec',
+        'conversion', 'conversion_spec', 'format_specs', 'references')
+
+    def __init__(self, formatter, literal_text, name, format_spec,
+            conversion):
+        self.literal_text = literal_text
+        self.name = name
+        self.format_spec = format_spec
+        self.conversion = conversion
+        if name is None:
+            self.accessor = self.conversion_spec = self.format_specs = None
+            self.references = None
+            self.plain = False
+            return
+        self.accessor = Accessor(name)
+        self.plain = not conversion and not format_spec and not (
+            self.accessor.kind == 'literal')
+        self.conversion_spec = formatter.compile_spec(conversion)
+        if '{' in format_spec:
+            self.format_specs = None
+            self.references = None
+        else:
+            self.format_specs = [formatter.compile_spec(spec)
+                for spec in format_spec.split(':')]
+            self.references = [accessor
+                for spec in [self.conversion_spec] + self.format_specs
+                for keys, accessor in spec.references]
+
+
+class Accessor(object):
+    """A compiled field name, for looking up its value in format arguments
+
+    kind is 'literal' for '='-prefixed names, 'index' for positional
+    arguments, 'key' for keyword arguments, and 'field' for anything
+    more complex, which is left to Formatter.get_field.
+    """
+    __slots__ = ('field_name', 'kind', 'key')
+
+    def __init__(self, field_name):
+        self.field_name = field_name
+        if field_name.startswith('='):
+            self.kind = 'literal'
+            self.key = field_name[1:]
+        elif field_name.isdigit():
+            self.kind = 'index'
+            self.key = int(field_name)
+        elif field_name and not any(c in field_name for c in '.['):
+            self.kind = 'key'
+            self.key = field_name
+        else:
+            self.kind = 'field'
+            self.key = field_name
+
+    def get(self, formatter, args, kwargs):
+        """Return (value, arg_used), like Formatter.get_field"""
+        kind = self.kind
+        if kind == 'index':
+            return args[self.key], self.key
+        elif kind == 'key':
+            return kwargs[self.key], self.key
+        elif kind == 'literal':
+            return self.key, None
+        else:
+            return formatter.get_field(self.key, args, kwargs)
+
+
+class CompiledSpec(object):
+    """A conversion or format spec part, resolved in advance
+
+    Shortcuts and key=value items are merged into category dicts; *ref items
+    are stored as (keys, accessor) pairs in references. keys is None for
+    bare *ref items, which use the word's interesting categories.
+    steps holds both, in order.
+
+    If there are no *ref items, categories is the resulting dict (which must
+    not be modified); otherwise it is None.
+    """
+    __slots__ = ('steps', 'references', 'categories')
+
+    def __init__(self, formatter, spec):
+        self.steps = []
+        self.references = []
+        categories = {}
+        for item in spec.split(',') if spec else ():
+            keys, sep, val = item.rpartition('=')
+            keys = tuple(keys.split('=')) if keys else None
+            if val.startswith('*'):
+                if categories:
+                    self.steps.append(categories)
+                    categories = {}
+                reference = keys, Accessor(val[1:])
+                self.steps.append(reference)
+                self.references.append(reference)
+            elif keys:
+                for key in keys:
+                    categories[key] = val
+            else:
+                categories.update(formatter.shortcuts[val])
+        if categories:
+            self.steps.append(categories)
+        if self.references:
+            self.categories = None
+        elif self.steps:
+            [self.categories] = self.steps
+        else:
+            self.categories = {}
+
+    def resolve(self, formatter, word, args, kwargs):
+        """Return the categories for inflecting word"""
+        if self.categories is not None:
+            return self.categories
+        result = {}
+        for step in self.steps:
+            if isinstance(step, dict):
+                result.update(step)
+                continue
+            keys, accessor = step
+            value = formatter.convert_field(
+                accessor.get(formatter, args, kwargs)[0])
+            if keys is None:
+                if word:
+                    keys = formatter.interesting_categories(word)
+                else:
+                    keys = ()
+            for key in keys:
+                result[key] = getattr(value, key)
+        return result
+
+
+class BaseTemplate(six.text_type):
+    """A string with language-specific magic in its format() method
+
+    Language modules subclass this, setting formatter to their Formatter.
+
+    If recorder is set to a forrin.instrument.Recorder, formatting
+    is recorded.
+    """
+    formatter = Formatter(None, BaseWord)
+    recorder = None
+
+    def format(self, *args, **kwargs):
+        return self.formatter.vformat(self, args, kwargs, self.recorder)
+
+    def format_many(self, rows):
+        """Format this template with many rows of arguments
+
+        See Formatter.format_many.
+        """
+        return self.formatter.format_many(self, rows, self.recorder)
+
 
 def parse_bool(b):
     if b and str(b) in '1 t true y yes True'.split():
@@ -2,14 +2,29 @@
 
 from __future__ import unicode_literals
 
+import io
+import os
+import copy
+import shutil
+import sqlite3
+import threading
+import tempfile
+import contextlib
+
 import pytest
 import six
 from six import StringIO
+import polib
 
 from forrin import extract
 from forrin import translator
+from forrin import tools
+from forrin import message
 import forrin.en
 import forrin.cs
+import forrin.instrument
+import forrin.backend
+import forrin.service
 
 
 class TestTranslations(object):
@@ -33,6 +48,52 @@ class ConstTranslations(object):
     def ngettext(self, message, plural, n):
         return self._string
 
+@contextlib.contextmanager
+def i18n_directory(catalogs):
+    """Create a temporary directory with .po files
+
+    catalogs maps language codes to dicts of msgid: msgstr
+    """
+    directory = tempfile.mkdtemp()
+    try:
+        for lang, messages in catalogs.items():
+            po = polib.POFile()
+            for msgid, msgstr in messages.items():
+                po.append(polib.POEntry(msgid=msgid, msgstr=msgstr))
+            po.save(os.path.join(directory, '%s.po' % lang))
+        yield directory
+    finally:
+        shutil.rmtree(directory)
+
+@contextlib.contextmanager
+def source_tree(files):
+    """Create a temporary directory with the given files
+
+    files maps relative paths to file contents
+    """
+    directory = tempfile.mkdtemp()
+    try:
+        for path, contents in files.items():
+            path = os.path.join(directory, path)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(path, 'w') as f:
+                f.write(contents)
+        yield directory
+    finally:
+        shutil.rmtree(directory)
+
+
+source_files = {
+        'a.py': "_('one')\n_('two', context='ctx')\n",
+        'b.py': "print(_('%s') % 3)\n",
+        'pkg/c.py': "_('one')\nx = 'no messages here'\n",
+        'pkg/d.py': "_('three', 'threes', n=3)\n",
+        'pkg/data.txt': "_('not extracted')\n",
+        'pkg/__init__.py': "import os\n",
+        'e.py': "my_function(x)\n",
+    }
+
 translation_inputs = [
         (('text',), dict()),
         (('one', 'two'), dict(n=1)),
@@ -178,6 +239,32 @@ def test_extraction_babel_mako():
     check_generator(func, args, output)
 
 
+def test_extraction_mako_files():
+    try:
+        import mako
+    except ImportError:
+        pytest.skip("Mako not installed")
+    template = """<%page args="x"/>
+        <p title="${_('title')}">${_('%s text') % x}</p>
+        <%
+            y = _('code')
+        %>
+        % if x:
+        ${_('{n} apple', '{n} apples', n=x).format(n=x)}
+        % endif
+    """
+    with source_tree({'t.mako': template, 'a.py': "_('one')\n"}) as directory:
+        messages = [(m.msgid, m.flags, m.occurrences[0][1]) for m in
+            tools.yield_messages(directory, jobs=2)
+            if m.occurrences[0][0].endswith('.mako')]
+    assert sorted(messages) == [
+        ('%s text', ['python-format'], 2),
+        ('code', [], 4),
+        ('title', [], 2),
+        ('{n} apple', ['python3-format'], 7),
+    ]
+
+
 # Translation tests #
 
 def test_en():
@@ -210,3 +297,864 @@ def test_cs():
             assert forrin.cs.Template(templ).format(*args, **kwargs) == out
         test.description = templ
         yield test
+
+
+def test_cs_format_many():
+    template = forrin.cs.Template('{0:case=2} {1:case=3}')
+    rows = [
+            ['mladý', 'jarní'],
+            ['jarní', 'mladý'],
+            ['mladý', 'jarní'],
+        ]
+    expected = [template.format(*row) for row in rows]
+    assert list(template.format_many(rows)) == expected
+
+
+def test_en_format_many_kwargs():
+    template = forrin.en.Template('{=a:*w} {w}')
+    rows = [dict(w='apple'), dict(w='pear'), dict(w='apple')]
+    assert list(template.format_many(rows)) == [
+        'an apple', 'a pear', 'an apple']
+
+
+def test_format_many_inflects_once():
+    inflected = []
+
+    class CountingWord(forrin.template.BaseWord):
+        def inflect(self, **kwargs):
+            inflected.append(self)
+            return self
+
+    formatter = forrin.template.Formatter('xx', CountingWord)
+    rows = [['a', 'b'], ['a', 'c'], ['a', 'b']]
+    results = formatter.format_many('{0:x=y} {1:x=z}', rows)
+    assert list(results) == ['a b', 'a c', 'a b']
+    assert sorted(inflected) == ['a', 'b', 'c']
+
+
+def test_plain_fields():
+    template = forrin.cs.Template('{0} files in {1:case=2}')
+    program = template.formatter.compile(template)
+    assert [field.plain for field in program.fields] == [True, False]
+    assert not program.plain
+    assert template.format(42, 'mladý') == '42 files in mladého'
+
+
+def test_plain_template():
+    template = forrin.cs.Template('{0} files, {n}')
+    assert template.formatter.compile(template).plain
+    assert template.format(42, n=7) == '42 files, 7'
+
+
+def test_compiled_spec():
+    class Word(forrin.template.BaseWord):
+        gender = 'f'
+        number = 'sg'
+
+    formatter = forrin.template.Formatter('xx', Word,
+        shortcuts=dict(gen=dict(case='2')))
+    spec = formatter.compile_spec('gen,number=pl')
+    assert spec.categories == dict(case='2', number='pl')
+    assert formatter.compile_spec('gen,number=pl') is spec
+    spec = formatter.compile_spec('case=3,number=gender=*0,case=4')
+    assert spec.categories is None
+    assert [accessor.key for keys, accessor in spec.references] == [0]
+    resolved = spec.resolve(formatter, Word('pear'), ['apple'], {})
+    assert resolved == dict(case='4', gender='f', number='sg')
+
+
+def test_word_props():
+    word = forrin.cs.Word.create('mladý', gender='f')
+    assert isinstance(word, forrin.cs.HardAdjective)
+    assert not hasattr(word, '__dict__')
+    assert word.gender == 'f'
+    assert word.inflect(case=2) == 'mladé'
+    other = forrin.cs.Word.create('starý', gender='f')
+    assert type(other) is type(word)
+    assert forrin.cs.Word.create('mladý').gender == 'm'
+
+
+def test_word_pickle():
+    import pickle
+    word = forrin.cs.Word.create('mladý', gender='f')
+    unpickled = pickle.loads(pickle.dumps(word))
+    assert unpickled == word
+    assert type(unpickled) is type(word)
+    phrase = forrin.cs.Word.create('jarní a mladý')
+    for copied in pickle.loads(pickle.dumps(phrase)), copy.copy(phrase):
+        assert copied == phrase
+        assert type(copied) is type(phrase)
+        assert copied.inflect(case=2) == 'jarního a mladého'
+
+
+def test_recorder():
+    recorder = forrin.instrument.Recorder()
+    catalogs = dict(cs={'Hello': 'Ahoj', 'Young': '@{0:case=2}!'})
+    with i18n_directory(catalogs) as directory:
+        _ = translator.BaseTranslator(languages=['cs', 'de'],
+            directory=directory, recorder=recorder)
+        assert _('Hello') == 'Ahoj'
+        assert _('Missing') == 'Missing'
+        assert _('Young').format('mladý') == 'mladého!'
+    counts = recorder.snapshot()['counts']
+    assert counts['translate'] == 3
+    assert counts['backend.build'] == 1
+    assert counts['backend.hit'] == 2
+    assert counts['backend.fallback'] == counts['backend.miss'] == 1
+    assert counts['template.create'] == 1
+    assert counts['template.format'] == 1
+    assert counts['word.create'] == counts['word.inflect'] == 1
+    assert set(recorder.snapshot()['times']) == set([
+        'translate', 'backend.build', 'backend.load', 'template.compile',
+        'template.format'])
+
+
+def test_parallel_extraction():
+    with source_tree(source_files) as directory:
+        def extract(jobs):
+            return [(m.msgid, m.msgid_plural, m.flags, m.occurrences)
+                for m in tools.yield_messages(directory, jobs=jobs)]
+        serial = extract(1)
+        assert sorted(m[0] for m in serial) == [
+            '%s', 'ctx|two', 'one', 'one', 'three']
+        assert extract(3) == serial
+
+
+def test_extraction_cache():
+    def extract(directory, cache):
+        printed = []
+        messages = [(m.msgid, m.flags, m.occurrences) for m in
+            tools.yield_messages(directory, printed.append, cache=cache)]
+        extracted = [p for p in printed if p.startswith('Extracting')]
+        return messages, len(extracted)
+
+    with source_tree(source_files) as directory:
+        cache_name = os.path.join(directory, 'cache.forrin-extract')
+        expected, count = extract(directory, None)
+        assert count == 4
+        assert extract(directory, tools.ExtractionCache(cache_name)) == (
+            expected, 4)
+        assert extract(directory, tools.ExtractionCache(cache_name)) == (
+            expected, 0)
+        with open(os.path.join(directory, 'b.py'), 'w') as f:
+            f.write("print(_('%s!') % 3)\n")
+        messages, count = extract(directory, tools.ExtractionCache(cache_name))
+        assert count == 1
+        assert [m[0] for m in messages] == [
+            '%s!' if m[0] == '%s' else m[0] for m in expected]
+
+
+def test_extraction_deeply_nested():
+    # A long chain of additions is a very deep tree
+    source = 'x = ' + ' + '.join("_('m%s') %% y" % i for i in range(2000))
+    messages = list(extract.extract_from_string(source, 'deep.py'))
+    assert [m.msgid for m in messages] == ['m%s' % i for i in range(2000)]
+    assert all(m.flags == ['python-format'] for m in messages)
+
+
+def test_extraction_prefilter():
+    assert extract.may_contain_messages("print(_ ('x'))")
+    assert extract.may_contain_messages("self._('x')")
+    assert not extract.may_contain_messages("my_function(x)")
+    assert not extract.may_contain_messages("_ = None")
+    assert extract.may_contain_messages("gettext('x')", ['_', 'gettext'])
+    with source_tree(source_files) as directory:
+        printed = []
+        list(tools.yield_messages(directory, printed.append))
+        assert 'Skipped 2 files with no messages' in printed
+
+
+def test_extraction_tokenize():
+    source = """if True:
+        print(_('d'))
+        print(_('d', n=6, plural='f'))
+        print(_(
+            'd', context='some_ctx'))
+        x = y % _('a') + _('b', comment=_('c'))
+        def _(a, *, b): pass
+        print(_('%s') % f)
+        print(_('{s}').format(s=1))
+        # _('not a message')
+        s = "_('not a message')" + '''
+            _('not a message')'''
+    """
+
+    def messages(method):
+        return [(m.msgid, m.msgid_plural, m.comment, m.flags, m.occurrences)
+            for m in extract.extract_from_string(source, 'f.py', method=method)]
+
+    assert len(messages('ast')) == 8
+    assert messages('tokenize') == messages('ast')
+    fragment = "for char in _('horse', 'horses', n=1):"
+    [message] = extract.extract_from_tokens(fragment, 'f')
+    assert message.msgid_plural == 'horses'
+
+
+def test_pot_writer():
+    messages = [
+        polib.POEntry(msgid='a', occurrences=[('a.py', 1)]),
+        polib.POEntry(msgid='b', msgid_plural='bs', occurrences=[('a.py', 2)],
+            flags=['python-format']),
+        polib.POEntry(msgid='a', occurrences=[('b.py', 3)], comment='A'),
+        polib.POEntry(msgid='b', occurrences=[('b.py', 4)]),
+        polib.POEntry(msgid='a', occurrences=[('c.py', 5)], comment='Á'),
+    ]
+    metadata = {'POT-Creation-Date': '2000-01-01'}
+    pot = message.POTFile(project_name='test', **metadata)
+    pot.add_messages(copy.deepcopy(messages))
+    writer = message.POTWriter(project_name='test', **metadata)
+    writer.add_messages(messages)
+    assert len(writer) == len(pot) == 3
+    with source_tree({}) as tmpdir:
+        pot.save(os.path.join(tmpdir, 'file.pot'))
+        writer.save(os.path.join(tmpdir, 'writer.pot'))
+        writer.close()
+        with io.open(os.path.join(tmpdir, 'file.pot'), encoding='utf-8') as f:
+            expected = f.read()
+        with io.open(os.path.join(tmpdir, 'writer.pot'), encoding='utf-8') as f:
+            assert f.read() == expected
+    assert '#: a.py:1 b.py:3 c.py:5' in expected
+
+
+def test_merge_index():
+    pot = polib.pofile('''
+#: a.py:1
+msgid "a"
+msgstr ""
+
+#: a.py:2
+#, python-format
+msgid "%s b"
+msgid_plural "%s bs"
+msgstr[0] ""
+msgstr[1] ""
+
+msgctxt "ctx"
+msgid "c"
+msgstr ""
+
+#: a.py:3
+msgid "new"
+msgstr ""
+''')
+    po_source = '''
+#, fuzzy
+msgid "a"
+msgstr "A"
+
+msgid "%s b"
+msgid_plural "%s bs"
+msgstr[0] "%s B"
+msgstr[1] ""
+
+msgctxt "ctx"
+msgid "c"
+msgstr "C"
+
+msgid "c"
+msgstr "no context"
+
+msgid "gone"
+msgstr "Gone"
+'''
+    expected = polib.pofile(po_source)
+    expected.merge(pot)
+    po = polib.pofile(po_source)
+    message.MergeIndex(pot).merge(po)
+    assert six.text_type(po) == six.text_type(expected)
+    assert [e.msgid for e in po.obsolete_entries()] == ['c', 'gone']
+
+
+def test_scan_catalog():
+    po_source = '''# Translation
+msgid ""
+msgstr ""
+"Content-Type: text/plain; charset=utf-8\\n"
+
+#: a.py:1
+#, fuzzy, python-format
+msgid "a"
+msgstr "A"
+
+#, python-format
+msgid ""
+"%s b\\n"
+"multiline"
+msgid_plural "%s bs"
+msgstr[0] "%s B"
+msgstr[1] ""
+
+msgid "d"
+msgid_plural "ds"
+msgstr[0] "D"
+msgstr[1] "Ds"
+msgctxt "ctx"
+msgid "c"
+msgstr "C"
+msgid "e \\"quoted\\""
+msgstr ""
+"E"
+
+#, fuzzy
+#~ msgid "gone"
+#~ msgstr "Gone"
+#. comment
+msgid "f"
+msgstr "F"
+'''
+    with source_tree({'cs.po': po_source}) as directory:
+        path = os.path.join(directory, 'cs.po')
+        expected = [(e.msgid_with_context, e.translated())
+            for e in polib.pofile(path) if not e.obsolete]
+        assert list(message.scan_catalog(path)) == expected
+        assert len(expected) == 6
+        keys = frozenset(['d', 'ctx\x04c', 'f', 'new'])
+        assert tools.count_translated(keys, path) == 3
+        assert tools.count_translated(keys, os.path.join(directory, 'x.po')) == 0
+
+
+def test_save_catalog():
+    po = polib.POFile()
+    po.append(polib.POEntry(msgid='a', msgstr='Á'))
+    with source_tree({}) as directory:
+        path = os.path.join(directory, 'cs.po')
+        assert tools.save_catalog(po, path, write=False)
+        assert not os.path.exists(path)
+        assert tools.save_catalog(po, path)
+        with io.open(path, encoding='utf-8') as f:
+            assert f.read() == six.text_type(po)
+        os.utime(path, (0, 0))
+        assert not tools.save_catalog(po, path)
+        assert os.stat(path).st_mtime == 0
+        po[0].msgstr = 'A'
+        assert tools.save_catalog(po, path)
+        assert os.stat(path).st_mtime != 0
+        assert os.listdir(directory) == ['cs.po']
+        # The file's mode is kept
+        os.chmod(path, 0o640)
+        po[0].msgstr = 'Á'
+        assert tools.save_catalog(po, path)
+        assert os.stat(path).st_mode & 0o777 == 0o640
+
+
+cs_plural_po = r'''
+msgid ""
+msgstr ""
+"Content-Type: text/plain; charset=utf-8\n"
+"Plural-Forms: nplurals=3; plural=(n==1) ? 0 : (n>=2 && n<=4) ? 1 : 2;\n"
+
+msgid "Hello"
+msgstr "Ahoj"
+
+msgid "{n} file"
+msgid_plural "{n} files"
+msgstr[0] "{n} soubor"
+msgstr[1] "{n} soubory"
+msgstr[2] "{n} souborů"
+
+msgid "{n} dog"
+msgid_plural "{n} dogs"
+msgstr[0] "{n} pes"
+msgstr[1] ""
+msgstr[2] ""
+'''
+
+
+def test_backend_plurals():
+    with source_tree({'cs.po': cs_plural_po}) as directory:
+        _ = translator.BaseTranslator(languages=['cs'], directory=directory)
+        assert [_('{n} file', '{n} files', n=n) for n in (1, 3, 5)] == [
+            '{n} soubor', '{n} soubory', '{n} souborů']
+        assert [_('{n} dog', '{n} dogs', n=n) for n in (1, 3)] == [
+            '{n} pes', '{n} dogs']
+        assert _('{n} cat', '{n} cats', n=1) == '{n} cat'
+
+
+def test_compile_catalogs():
+    with source_tree({'cs.po': cs_plural_po}) as directory:
+        class Translator(translator.BaseTranslator):
+            package = 'test'
+            precompiled = True
+        db_name = os.path.join(directory, 'test.forrin-db')
+        catalogs = [('cs', os.path.join(directory, 'cs.po'))]
+        tools.compile_catalogs(db_name, 'test', catalogs, write=False)
+        assert os.listdir(directory) == ['cs.po']
+        with pytest.raises(Exception):
+            Translator(languages=['cs'], directory=directory)
+        tools.compile_catalogs(db_name, 'test', catalogs)
+        umask = os.umask(0)
+        os.umask(umask)
+        assert os.stat(db_name).st_mode & 0o777 == 0o666 & ~umask
+        os.chmod(db_name, 0o640)
+        tools.compile_catalogs(db_name, 'test', catalogs)
+        assert os.stat(db_name).st_mode & 0o777 == 0o640
+        os.unlink(os.path.join(directory, 'cs.po'))
+        _ = Translator(languages=['de', 'cs'], directory=directory)
+        assert _('Hello') == 'Ahoj'
+        assert _('{n} file', '{n} files', n=3) == '{n} soubory'
+        assert _('Bye') == 'Bye'
+        assert sorted(os.listdir(directory)) == [
+            'test.forrin-db', 'test.forrin-db.lock']
+        # A database with an old schema is rejected
+        db = sqlite3.connect(db_name)
+        db.execute('PRAGMA user_version = 0')
+        db.commit()
+        db.close()
+        with pytest.raises(ValueError):
+            forrin.backend.connect(db_name, readonly=True)
+
+
+def test_connect_concurrently():
+    # Workers opening a new database at the same time all get the schema
+    with source_tree({}) as directory:
+        for attempt in range(10):
+            filename = os.path.join(directory, '%s.forrin-db' % attempt)
+            errors = []
+
+            def open_catalog():
+                try:
+                    db = forrin.backend.connect(filename)
+                    db.execute('SELECT * FROM translation').fetchall()
+                    db.close()
+                except Exception as e:
+                    errors.append(e)
+
+            threads = [threading.Thread(target=open_catalog)
+                for i in range(8)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            assert errors == []
+
+
+def test_verify_catalog():
+    db = sqlite3.connect(':memory:')
+    forrin.backend.create_schema(db)
+    forrin.backend.verify_catalog(db)
+    db.execute("""INSERT INTO language (domain, lang, plural_forms)
+        VALUES ('test', 'xx', 'nplurals=2; plural=n>1 ? 2 : 0;')""")
+    with pytest.raises(ValueError):
+        forrin.backend.verify_catalog(db)
+
+
+def test_catalog_store():
+    other_po = polib.POFile()
+    other_po.append(polib.POEntry(msgid='Hello', msgstr='Nazdar'))
+    other_po.append(polib.POEntry(msgid='Dog', msgstr='Pes'))
+    with source_tree({'cs.po': cs_plural_po}) as directory:
+        os.mkdir(os.path.join(directory, 'other'))
+        other_po.save(os.path.join(directory, 'other', 'cs.po'))
+        store_path = os.path.join(directory, 'shared.forrin-db')
+
+        class Translator(translator.BaseTranslator):
+            package = 'test'
+            catalog_store = store_path
+
+        class OtherTranslator(Translator):
+            package = 'other'
+
+        _ = Translator(languages=['cs'], directory=directory)
+        other = OtherTranslator(languages=['cs'],
+            directory=os.path.join(directory, 'other'))
+        assert _('Hello') == 'Ahoj'
+        assert other('Hello') == 'Nazdar'
+        assert other('Dog') == 'Pes'
+        assert _('Dog') == 'Dog'
+        assert _('{n} file', '{n} files', n=3) == '{n} soubory'
+        assert other('{n} file', '{n} files', n=3) == '{n} files'
+        # One connection, and one row per source string
+        assert _.translation.store is other.translation.store
+        db = _.translation.db
+        [[count]] = db.execute(
+            "SELECT COUNT(*) FROM source WHERE text='Hello'").fetchall()
+        assert count == 1
+        forrin.backend.verify_catalog(db)
+
+        # Compiling one domain keeps the others
+        tools.compile_catalogs(store_path, 'other',
+            [('cs', os.path.join(directory, 'other', 'cs.po'))])
+        tools.compile_catalogs(store_path, 'test', [])
+        store = forrin.backend.get_store(store_path, readonly=True)
+        assert not store.has_language('test', 'cs')
+        assert store.has_language('other', 'cs')
+        assert forrin.backend.get_store(store_path, readonly=True) is store
+        [[count]] = store.db.execute("SELECT COUNT(*) FROM source").fetchall()
+        assert count == 2
+
+        # Concurrent compiles don't lose each other's domains
+        lost = []
+
+        def compile_domain(domain, po_path):
+            for i in range(10):
+                tools.compile_catalogs(store_path, domain, [('cs', po_path)])
+                db = forrin.backend.connect(store_path, readonly=True)
+                if not db.execute("SELECT 1 FROM language WHERE domain = ?",
+                        [domain]).fetchall():
+                    lost.append(domain)
+                db.close()
+
+        threads = [
+            threading.Thread(target=compile_domain, args=(
+                'test', os.path.join(directory, 'cs.po'))),
+            threading.Thread(target=compile_domain, args=(
+                'other', os.path.join(directory, 'other', 'cs.po'))),
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert lost == []
+        store = forrin.backend.get_store(store_path, readonly=True)
+        assert store.has_language('test', 'cs')
+        assert store.has_language('other', 'cs')
+
+        # Shared stores must be given by absolute path
+        class RelativeTranslator(translator.BaseTranslator):
+            catalog_store = 'shared.forrin-db'
+        with pytest.raises(ValueError):
+            RelativeTranslator(languages=['cs'], directory=directory)
+
+
+def test_backend_shards():
+    po = polib.POFile()
+    for msgid, filename in [('a', 'a.py'), ('b', 'a.py'), ('c', 'c.py')]:
+        po.append(polib.POEntry(msgid=msgid, msgstr=msgid.upper(),
+            occurrences=[(filename, 1)]))
+    po.append(polib.POEntry(msgid='d', occurrences=[('c.py', 2)]))
+    with source_tree({}) as directory:
+        po.save(os.path.join(directory, 'cs.po'))
+        recorder = forrin.instrument.Recorder()
+        _ = translator.BaseTranslator(languages=['cs'], directory=directory,
+            recorder=recorder)
+        assert _('a') == 'A'
+        assert _('b') == 'B'
+        assert _('x') == 'x'
+        assert _('a') == 'A'
+        backend = _.translation
+        assert backend._loaded_shards == set(['a.py'])
+        assert _('d') == 'd'
+        assert backend._loaded_shards == set(['a.py'])
+        assert _('c') == 'C'
+        assert backend._loaded_shards == set(['a.py', 'c.py'])
+        assert recorder.counts['backend.load'] == 2
+
+
+@contextlib.contextmanager
+def translation_server(directory, catalogs):
+    """Compile catalogs in directory, and serve them; yield the socket path
+    """
+    tools.compile_catalogs(os.path.join(directory, 'test.forrin-db'),
+        'test', catalogs)
+    socket_path = os.path.join(directory, 'socket')
+    server = forrin.service.TranslationServer(socket_path, directory, 'test')
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    try:
+        yield socket_path
+    finally:
+        server.shutdown()
+        server.server_close()
+        thread.join()
+
+
+def test_service():
+    with source_tree({'cs.po': cs_plural_po}) as directory:
+        catalogs = [('cs', os.path.join(directory, 'cs.po'))]
+        with translation_server(directory, catalogs) as socket_path:
+            backend = forrin.service.ServiceBackend(
+                socket_path, ['cs'], batch_size=2)
+            _ = translator.BaseTranslator(languages=['cs'],
+                translations=backend)
+            assert _('Hello') == 'Ahoj'
+            assert _('Bye') == 'Bye'
+            assert _('{n} file', '{n} files', n=3) == '{n} soubory'
+            backend.prefetch([('Hello', ), ('a', ), ('b', ), ('c', ),
+                ('{n} file', '{n} files', 5)])
+            assert len(backend.cache) == 6
+            # Plural forms are chosen locally, for any n
+            assert [backend.ngettext('{n} file', '{n} files', n)
+                for n in (1, 5, 4, 100)] == [
+                    '{n} soubor', '{n} souborů', '{n} soubory', '{n} souborů']
+            assert [backend.ngettext('{n} dog', '{n} dogs', n)
+                for n in (1, 2)] == ['{n} pes', '{n} dogs']
+            assert len(backend.cache) == 7
+            with pytest.raises(RuntimeError):
+                backend.prefetch([('x', ), ('y', ), ('a', 'b', 'c', 'd')])
+            assert backend.gettext('Hello') == 'Ahoj'
+            assert backend.gettext('z') == 'z'
+            assert _('Hello') == 'Ahoj'
+            backend.close()
+
+
+def test_service_threads():
+    catalogs = dict(cs=dict(('m%d' % i, 'T%d' % i) for i in range(100)))
+    with i18n_directory(catalogs) as directory:
+        catalogs = [('cs', os.path.join(directory, 'cs.po'))]
+        with translation_server(directory, catalogs) as socket_path:
+            backend = forrin.service.ServiceBackend(socket_path, ['cs'])
+            results = []
+
+            def work(start):
+                results.extend((i, backend.gettext('m%d' % i))
+                    for i in range(start, 100, 4))
+
+            threads = [threading.Thread(target=work, args=(i, ))
+                for i in range(4)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            backend.close()
+            assert sorted(results) == [(i, 'T%d' % i) for i in range(100)]
+
+
+def test_service_large_prefetch():
+    # Requests and responses much larger than the socket buffers
+    catalogs = dict(cs={'m0': 'T0'})
+    with i18n_directory(catalogs) as directory:
+        catalogs = [('cs', os.path.join(directory, 'cs.po'))]
+        with translation_server(directory, catalogs) as socket_path:
+            backend = forrin.service.ServiceBackend(socket_path, ['cs'])
+            msgids = ['m%d %s' % (i, 'x' * 200) for i in range(20000)]
+            prefetch = threading.Thread(
+                target=backend.preload, args=(msgids + ['m0'], ))
+            prefetch.daemon = True
+            prefetch.start()
+            prefetch.join(60)
+            assert not prefetch.is_alive()
+            assert len(backend.cache) == 20001
+            assert backend.gettext('m0') == 'T0'
+            backend.close()
+
+
+def test_message_profile():
+    profile = forrin.instrument.MessageProfile(interval=2)
+    _ = translator.BaseTranslator(translations=TestTranslations(),
+        profile=profile)
+    for i in range(4):
+        _('a')
+    for i in range(2):
+        _('b', 'bs', n=1, context='ctx')
+    assert profile.counts == {('a', None, None): 2, ('b', 'bs', 'ctx'): 1}
+    assert profile.hot_messages() == [('a', None, None), ('b', 'bs', 'ctx')]
+    with source_tree({}) as directory:
+        filename = os.path.join(directory, 'profile.json')
+        profile.save(filename, limit=1)
+        assert forrin.instrument.load_profile(filename) == [
+            ('a', None, None)]
+    # The same message with and without a plural or context
+    profile = forrin.instrument.MessageProfile()
+    profile.record('a')
+    profile.record('a', 'as')
+    profile.record('a', context='ctx')
+    assert profile.hot_messages() == [
+        ('a', None, None), ('a', None, 'ctx'), ('a', 'as', None)]
+
+
+def test_preload():
+    catalogs = dict(
+        cs={'Hello': 'Ahoj', 'Young': '@{0:case=3}?', 'ctx|Bye': 'Nashle'},
+        de={'Hello': 'Hallo', 'Dog': 'Hund'})
+    with i18n_directory(catalogs) as directory:
+        recorder = forrin.instrument.Recorder()
+        _ = translator.BaseTranslator(languages=['cs', 'de'],
+            directory=directory, recorder=recorder)
+        _.preload([('Hello', None, None), ('Young', None, None),
+            ('Dog', None, None), ('Bye', None, 'ctx'), ('No', None, None)])
+        assert 'backend.load' not in recorder.counts
+        assert recorder.counts['template.compile'] == 1
+        assert sorted(_.translation._catalog) == [
+            'Dog', 'Hello', 'No', 'Young', 'ctx|Bye']
+        assert _.translation.fallback._catalog == {'Dog': {0: 'Hund'},
+            'No': None}
+        recorder.reset()
+        assert _('Bye', context='ctx') == 'Nashle'
+        assert _('Dog') == 'Hund'
+        assert _('Young').format('mladý') == 'mladému?'
+        assert 'template.compile' not in recorder.counts
+        assert 'backend.load' not in recorder.counts
+
+
+def test_snapshot():
+    catalogs = dict(
+        cs={'Hello': 'Ahoj', 'Old': '@{0:case=4}!'},
+        de={'Hello': 'Hallo', 'Dog': 'Hund'})
+    with i18n_directory(catalogs) as directory:
+        path = os.path.join(directory, 'test.forrin-snapshot')
+        _ = translator.BaseTranslator(languages=['cs', 'de'],
+            directory=directory)
+        assert not _.restore_snapshot(path)
+        assert _('Hello') == 'Ahoj'
+        assert _('Dog') == 'Hund'
+        assert _('Old').format('mladý') == 'mladého!'
+        _.save_snapshot(path)
+        assert not [name for name in os.listdir(directory)
+            if name.endswith('.tmp')]
+        os.chmod(path, 0o640)
+        _.save_snapshot(path)
+        assert os.stat(path).st_mode & 0o777 == 0o640
+        del forrin.cs.formatter._programs['{0:case=4}!']
+
+        recorder = forrin.instrument.Recorder()
+        restored = translator.BaseTranslator(languages=['cs', 'de'],
+            directory=directory, recorder=recorder)
+        assert restored.restore_snapshot(path)
+        assert restored.translation._catalog == _.translation._catalog
+        assert restored.translation.fallback._catalog == (
+            _.translation.fallback._catalog)
+        assert restored('Hello') == 'Ahoj'
+        assert restored('Dog') == 'Hund'
+        assert restored('Old').format('mladý') == 'mladého!'
+        assert restored.translation.plural(5) == 1
+        assert 'backend.load' not in recorder.counts
+        assert 'template.compile' not in recorder.counts
+
+        # Snapshots of other languages, or of changed catalogs, are rejected
+        other = translator.BaseTranslator(languages=['de'],
+            directory=directory)
+        assert not other.restore_snapshot(path)
+        with open(os.path.join(directory, 'cs.po'), 'a') as po_file:
+            po_file.write('\n')
+        stale = translator.BaseTranslator(languages=['cs', 'de'],
+            directory=directory)
+        assert not stale.restore_snapshot(path)
+        assert stale.translation._catalog == {}
+
+        # Unreadable snapshots are rejected too
+        with open(path, 'rb') as snapshot_file:
+            data = snapshot_file.read()
+        with open(path, 'wb') as snapshot_file:
+            snapshot_file.write(data[:len(data) // 2])
+        assert not stale.restore_snapshot(path)
+
+
+def test_bloom_filter():
+    keys = ['message %d' % i for i in range(1000)]
+    key_filter = forrin.backend.BloomFilter.build(keys)
+    assert all(key in key_filter for key in keys)
+    others = sum('other %d' % i in key_filter for i in range(1000))
+    assert others < 50
+    copied = forrin.backend.BloomFilter(key_filter.to_bytes())
+    assert all(key in copied for key in keys)
+    assert 'x' not in forrin.backend.BloomFilter.build([])
+
+
+def test_backend_key_filter():
+    catalogs = dict(cs={'Hello': 'Ahoj'}, de={'Hello': 'Hallo', 'Dog': 'Hund'})
+    with i18n_directory(catalogs) as directory:
+        _ = translator.BaseTranslator(languages=['cs', 'de'],
+            directory=directory)
+        assert _('Dog') == 'Hund'
+        backend = _.translation
+        # Few misses are remembered
+        backend.max_misses = backend.fallback.max_misses = 10
+        for i in range(100):
+            assert _('Missing %d' % i) == 'Missing %d' % i
+        assert set(backend._catalog) <= set(['Dog', 'Hello'])
+        assert set(backend.fallback._catalog) <= set(['Dog', 'Hello'])
+        assert len(backend._misses) <= 10
+        assert len(backend.fallback._misses) <= 10
+        backend.db.close()
+        # Misses don't touch the (now closed) database
+        assert _('Missing') == 'Missing'
+
+
+def test_shared_templates():
+    catalogs = dict(cs={'Young': '@{0:case=5}!', 'Old': 'Starý'})
+    with i18n_directory(catalogs) as directory:
+        _ = translator.BaseTranslator(languages=['cs'], directory=directory)
+        template = _('Young')
+        assert isinstance(template, forrin.cs.Template)
+        assert _('Young') is template
+        assert template.format('mladý') == 'mladý!'
+        assert _('Old') == 'Starý'
+    assert translator.template_class('cs') is forrin.cs.Template
+    assert translator.template_class('xx') is forrin.template.BaseTemplate
+
+
+def test_source_mode():
+    catalogs = dict(cs={'Hello': 'Ahoj'})
+    with i18n_directory(catalogs) as directory:
+        for _ in [
+                translator.BaseTranslator(),
+                translator.BaseTranslator(languages=['en', 'de'],
+                    directory=directory),
+                translator.BaseTranslator(languages=['en', 'cs'],
+                    directory=directory),
+                translator.NullTranslator(),
+            ]:
+            assert getattr(_, 'source_mode', True)
+            assert _('Hello') == 'Hello'
+            assert _('Hello', context='ctx') == 'Hello'
+            assert _('a|b') == 'a|b'
+            assert _('one', 'many', n=1) == 'one'
+            assert _('one', 'many', n=5) == 'many'
+            assert _(translator._('one', 'many', n=5, context='c')) == 'many'
+            template = _('@{0:*0} {0}')
+            assert _('@{0:*0} {0}') is template
+        _ = translator.BaseTranslator(languages=['de', 'cs'],
+            directory=directory)
+        assert not _.source_mode
+        assert _.translation.languages == ['cs']
+        assert _('Hello') == 'Ahoj'
+
+        class Translator(translator.BaseTranslator):
+            source_language = 'de'
+        _ = Translator(languages=['de', 'cs'], directory=directory)
+        assert _.source_mode
+        assert _('Hello') == 'Hello'
+
+    # A catalog for the source language is used
+    catalogs = dict(en={'colour': 'color'}, cs={'colour': 'barva'})
+    with i18n_directory(catalogs) as directory:
+        _ = translator.BaseTranslator(languages=['en', 'cs'],
+            directory=directory)
+        assert not _.source_mode
+        assert _('colour') == 'color'
+        assert _('Hello') == 'Hello'
+
+
+def test_lazy_strings():
+    catalogs = dict(cs={'Hello': 'Ahoj', 'Young': '@{0:case=2} {1}'},
+        de={'Hello': 'Hallo'})
+    with i18n_directory(catalogs) as directory:
+        created = []
+
+        class Translator(translator.BaseTranslator):
+            def __init__(self, *args, **kwargs):
+                created.append(kwargs['languages'])
+                super(Translator, self).__init__(*args, **kwargs)
+
+        lazy = translator.LazyTranslator(Translator, directory=directory)
+        menu = [lazy('Hello'), lazy('Young'), lazy('one', 'many', n=2)]
+        assert created == []
+        assert [six.text_type(s) for s in menu] == [
+            'Hello', 'Young', 'many']
+        with translator.active_languages(['cs']):
+            assert six.text_type(menu[0]) == 'Ahoj'
+            assert menu[0] == 'Ahoj'
+            assert menu[1].format('mladý', '!') == 'mladého !'
+            assert '{0}!'.format(menu[0]) == 'Ahoj!'
+            assert menu[0] + '!' == 'Ahoj!'
+            assert len(menu[0]) == 4
+            with translator.active_languages(['de', 'cs']):
+                assert '%s' % menu[0] == 'Hallo'
+                assert menu[0].upper() == 'HALLO'
+            assert translator.get_languages() == ('cs', )
+            assert '-' + menu[0] == '-Ahoj'
+        assert translator.get_languages() is None
+        assert created == [None, ['cs'], ['de', 'cs']]
+        assert menu[0]._cache == {None: 'Hello', ('cs', ): 'Ahoj',
+            ('de', 'cs'): 'Hallo'}
+        # Copies don't resolve the message
+        assert copy.copy(menu[0]) is menu[0]
+        assert copy.deepcopy(menu) == menu
+        # Equal objects have equal hashes
+        assert menu[0] == 'Hello'
+        assert 'Hello' in set([menu[0]])
+        assert menu[0] in set(['Hello'])
+        with translator.active_languages(['cs']):
+            assert 'Ahoj' in set([menu[0]])
+            assert menu[0] in set(['Ahoj'])
+            assert menu[0] not in set(['Hello'])
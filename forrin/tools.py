@@ -9,29 +9,366 @@ Then, call the run method.
 from __future__ import print_function, unicode_literals, division
 
 import os
+import json
+import functools
+import sqlite3
+import shutil
+import hashlib
 import argparse
+import contextlib
 import textwrap
 
 import six
+from six.moves import zip
 import pkg_resources
 import polib
 
+try:
+    from concurrent.futures import ProcessPoolExecutor
+except ImportError:
+    # Python 2 without the futures backport: no parallel processing
+    ProcessPoolExecutor = None
+
+try:
+    import fcntl
+except ImportError:
+    # Not on Unix: no file locking
+    fcntl = None
+
+import forrin
 import forrin.extract
-from forrin.message import POTFile
+import forrin.backend
+from forrin.message import POTFile, POTWriter, MergeIndex, scan_catalog
+from forrin.util import atomic_write
 
 
-def yield_messages(source_dir, printer=lambda *a, **ka: None):
-    """Yield messages from all Python sources in the source_dir tree
+def map_jobs(function, iterable, jobs=1):
+    """Like map(), but using up to `jobs` worker processes
 
-    Feel free to use this as an example
+    Results are yielded in order, as soon as they are available.
+    The function and its arguments and results must be picklable.
+    """
+    if jobs > 1 and ProcessPoolExecutor is not None:
+        with ProcessPoolExecutor(jobs) as executor:
+            for result in executor.map(function, iterable, chunksize=8):
+                yield result
+    else:
+        for item in iterable:
+            yield function(item)
+
+
+def source_files(source_dir):
+    """Yield paths of all sources in the source_dir tree
+
+    These are Python files, and Mako templates if Mako is installed.
     """
     for dirpath, dirnames, filenames in os.walk(source_dir):
         for filename in filenames:
-            if filename.endswith('.py'):
-                filepath = os.path.join(dirpath, filename)
+            if filename.endswith(source_extensions):
+                yield os.path.join(dirpath, filename)
+
+if hasattr(forrin.extract, 'extract_mako_from_string'):
+    source_extensions = ('.py', '.mako')
+else:
+    source_extensions = ('.py', )
+
+
+def extract_file(filepath, method='ast'):
+    """Return a list of messages from the given file
+
+    Returns None if the file was skipped because it contains nothing that
+    looks like a call of the _ function.
+    The method is passed to forrin.extract.extract_from_string;
+    Mako templates are always tokenized.
+    """
+    with open(filepath) as fileobj:
+        source = fileobj.read()
+    if not forrin.extract.may_contain_messages(source):
+        return None
+    if filepath.endswith('.mako'):
+        return list(forrin.extract.extract_mako_from_string(
+            source, filepath))
+    return list(forrin.extract.extract_from_string(
+        source, filepath, method=method))
+
+
+def merge_file(index, po_path):
+    """Merge a MergeIndex into the .po file at po_path, return the POFile
+
+    If the file doesn't exist, a new POFile is created.
+    The file itself is not modified.
+    """
+    if os.path.exists(po_path):
+        po = polib.pofile(po_path)
+    else:
+        po = polib.POFile()
+    index.merge(po)
+    return po
+
+
+def strip_catalog(po):
+    """Remove data unnecessary for translations from a POFile, in place
+
+    Untranslated messages are removed, and so are occurrences, flags and
+    comments of the rest.
+    """
+    po[:] = [m for m in po if m.msgstr]
+    for message in po:
+        message.occurrences = []
+        message.flags = []
+        message.comment = message.tcomment = ''
+
+
+def save_catalog(po, po_path, write=True):
+    """Save a POFile to po_path, unless the file already has that content
+
+    Returns true if the file's content changed (or, if write is false,
+    would change). The file is replaced atomically, so readers never see
+    a partially written file.
+    """
+    data = six.text_type(po).encode(po.encoding)
+    if os.linesep != '\n':
+        data = data.replace(b'\n', os.linesep.encode('ascii'))
+    try:
+        with open(po_path, 'rb') as fileobj:
+            if fileobj.read() == data:
+                return False
+    except (IOError, OSError):
+        pass
+    if write:
+        with atomic_write(po_path) as tmp_path:
+            with open(tmp_path, 'wb') as fileobj:
+                fileobj.write(data)
+    return True
+
+
+def update_file(index, strip, write, po_path):
+    """Merge a MergeIndex into the .po file at po_path and save it
+
+    If strip is true, the catalog is stripped using strip_catalog.
+    Returns (existed, changed): whether the file existed before, and
+    whether its content changed.
+    """
+    existed = os.path.exists(po_path)
+    po = merge_file(index, po_path)
+    if strip:
+        strip_catalog(po)
+    return existed, save_catalog(po, po_path, write)
+
+
+def compile_catalogs(filename, domain, catalogs, write=True):
+    """Build the backend's catalogs of a domain from .po files
+
+    catalogs is a list of (lang, po_path) pairs.
+    Catalogs of other domains in the database are kept, so one database can
+    serve several domains.
+    The database is built in a temporary file and verified; only then it
+    replaces filename (if write is true).
+
+    When writing, an exclusive lock on filename + '.lock' is held, so
+    domains can be compiled into one database concurrently. Without fcntl
+    (i.e. not on Unix), such compiles must be run one at a time.
+    """
+    if write:
+        with lock_file(filename + '.lock'):
+            _compile_catalogs(filename, domain, catalogs, write)
+    else:
+        _compile_catalogs(filename, domain, catalogs, write)
+
+
+def _compile_catalogs(filename, domain, catalogs, write):
+    with atomic_write(filename, replace=write) as tmp_path:
+        if os.path.exists(filename):
+            shutil.copyfile(filename, tmp_path)
+        db = forrin.backend.connect(tmp_path)
+        try:
+            db.execute('''DELETE FROM translation WHERE domain = ?''',
+                [domain])
+            db.execute('''DELETE FROM language WHERE domain = ?''', [domain])
+            for lang, po_path in catalogs:
+                forrin.backend.build_language(db, domain, lang, po_path)
+            forrin.backend.remove_unused_sources(db)
+            db.commit()
+            forrin.backend.verify_catalog(db)
+        finally:
+            db.close()
+
+
+@contextlib.contextmanager
+def lock_file(path):
+    """Hold an exclusive lock on the file at path, creating it if needed
+
+    Without fcntl, no lock is taken.
+    """
+    with open(path, 'a') as fileobj:
+        if fcntl is not None:
+            fcntl.flock(fileobj.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(fileobj.fileno(), fcntl.LOCK_UN)
+
+
+def count_translated(keys, po_path):
+    """Return how many of the given message keys are translated in po_path
+
+    Keys are msgid_with_context values; the file may not exist.
+    """
+    if not os.path.exists(po_path):
+        return 0
+    return sum(1 for key, translated in scan_catalog(po_path)
+        if translated and key in keys)
+
+
+class ExtractionCache(object):
+    """Persistent cache of messages extracted from source files
+
+    A file's cached messages are used while its mtime and size don't change.
+    If they do change, the file's content hash is checked before
+    extracting again.
+
+    The cache is stored in a SQLite database. Changes are only written
+    when save() is called, and only if `write` is true.
+    Everything cached by a different `version` is discarded.
+    """
+    def __init__(self, filename, write=True, version=forrin.__version__):
+        self.filename = filename
+        self.write = write
+        try:
+            self.db = sqlite3.connect(filename)
+        except sqlite3.Error:
+            # Can't connect, use temporary DB
+            self.db = sqlite3.connect(":memory:")
+        self.db.execute('''CREATE TABLE IF NOT EXISTS meta (
+                key TEXT PRIMARY KEY,
+                value TEXT)
+            ''')
+        self.db.execute('''CREATE TABLE IF NOT EXISTS file (
+                path TEXT PRIMARY KEY,
+                mtime INTEGER,
+                size INTEGER,
+                hash TEXT,
+                messages TEXT)
+            ''')
+        # Messages extracted by a different version are not trusted
+        for [stored_version] in self.db.execute('''SELECT value FROM meta
+                WHERE key = ?''', ['version']):
+            if stored_version == version:
+                break
+        else:
+            self.db.execute('DELETE FROM file')
+            self.db.execute('''INSERT OR REPLACE INTO meta (key, value)
+                VALUES ('version', ?)''', [version])
+
+    def lookup(self, filepath):
+        """Return cached messages for the given file, or None
+        """
+        stat = os.stat(filepath)
+        for mtime, size, hash, messages in self.db.execute('''
+                SELECT mtime, size, hash, messages
+                FROM file
+                WHERE path = ?
+                ''', [filepath]):
+            if mtime != stat.st_mtime or size != stat.st_size:
+                if hash != file_hash(filepath):
+                    return None
+                self.db.execute('''UPDATE file SET mtime = ?, size = ?
+                    WHERE path = ?''', (stat.st_mtime, stat.st_size, filepath))
+            return [message_from_json(m) for m in json.loads(messages)]
+        return None
+
+    def store(self, filepath, messages):
+        """Store the messages extracted from the given file"""
+        stat = os.stat(filepath)
+        self.db.execute('''INSERT OR REPLACE INTO file
+            (path, mtime, size, hash, messages) VALUES (?, ?, ?, ?, ?)
+            ''', (filepath, stat.st_mtime, stat.st_size, file_hash(filepath),
+                json.dumps([message_to_json(m) for m in messages])))
+
+    def prune(self, filepaths):
+        """Forget all files except the given ones"""
+        keep = set(filepaths)
+        stale = [[path] for [path] in self.db.execute('SELECT path FROM file')
+            if path not in keep]
+        self.db.executemany('DELETE FROM file WHERE path = ?', stale)
+
+    def save(self):
+        if self.write:
+            self.db.commit()
+
+
+def file_hash(filepath):
+    """Return a hash of the given file's contents"""
+    with open(filepath, 'rb') as fileobj:
+        return hashlib.sha1(fileobj.read()).hexdigest()
+
+
+def message_to_json(message):
+    """Convert an extracted message to a JSON-serializable dict"""
+    return dict(
+        msgid=message.msgid,
+        msgid_plural=message.msgid_plural,
+        occurrences=message.occurrences,
+        comment=message.comment,
+        flags=message.flags,
+    )
+
+
+def message_from_json(data):
+    """Convert the result of message_to_json back to a message"""
+    return polib.POEntry(
+        msgid=data['msgid'],
+        msgid_plural=data['msgid_plural'],
+        occurrences=[tuple(o) for o in data['occurrences']],
+        comment=data['comment'],
+        flags=data['flags'],
+    )
+
+
+def yield_messages(source_dir, printer=lambda *a, **ka: None, jobs=1,
+        cache=None, method='ast'):
+    """Yield messages from all Python sources in the source_dir tree
+
+    With jobs > 1, files are processed in that many worker processes;
+    messages are still yielded in the same order.
+
+    If an ExtractionCache is given, only files that changed are processed.
+    The cache is saved after all messages are yielded.
+
+    The method is passed to forrin.extract.extract_from_string.
+
+    Feel free to use this as an example
+    """
+    filepaths = list(source_files(source_dir))
+    if cache is None:
+        cached = [None] * len(filepaths)
+    else:
+        cached = [cache.lookup(filepath) for filepath in filepaths]
+    to_extract = [filepath for filepath, messages in zip(filepaths, cached)
+        if messages is None]
+    if cache is not None:
+        printer('Using cached messages for %s files' % (
+            len(filepaths) - len(to_extract)))
+    results = map_jobs(
+        functools.partial(extract_file, method=method), to_extract, jobs)
+    skipped = 0
+    for filepath, messages in zip(filepaths, cached):
+        if messages is None:
+            messages = next(results)
+            if messages is None:
+                skipped += 1
+                messages = []
+            else:
                 printer('Extracting from %s' % filepath)
-                for message in forrin.extract.extract_python(filepath):
-                    yield message
+            if cache is not None:
+                cache.store(filepath, messages)
+        for message in messages:
+            yield message
+    printer('Skipped %s files with no messages' % skipped)
+    if cache is not None:
+        cache.prune(filepaths)
+        cache.save()
 
 
 class ForrinTools(object):
@@ -43,24 +380,53 @@ class ForrinTools(object):
         self.i18n_dir = translator.i18n_directory
         self.domain = translator.domain
         self.pot_name = os.path.join(self.i18n_dir, '%s.pot' % self.domain)
+        self.cache_name = os.path.join(
+            self.i18n_dir, '%s.forrin-extract' % self.domain)
+        self.db_name = translator.catalog_store or os.path.join(
+            self.i18n_dir, '%s.forrin-db' % translator.package)
+        self.socket_name = os.path.join(
+            self.i18n_dir, '%s.forrin-socket' % translator.package)
 
         if not source_dir:
             source_dir = pkg_resources.resource_filename(
                 self.translator.package, '')
         self.source_dir = source_dir
 
-    def yield_messages(self, printer=lambda *a, **ka: None):
+    def yield_messages(self, printer=lambda *a, **ka: None, jobs=1,
+            cache=None, method='ast'):
         """Yield all messages for this domain"""
-        return yield_messages(self.source_dir, printer)
+        return yield_messages(self.source_dir, printer, jobs, cache, method)
+
+    def get_cache(self, args):
+        """Return the ExtractionCache to use, or None
+
+        With --dry-run, the cache is only used if it already exists,
+        and it is never saved.
+        """
+        if not args.extract_cache:
+            return None
+        if not args.write and not os.path.exists(self.cache_name):
+            return None
+        # Switching extraction methods invalidates the cache
+        version = '%s %s' % (forrin.__version__, args.extract_method)
+        return ExtractionCache(self.cache_name, write=args.write,
+            version=version)
 
-    def extract(self, args):
+    def extract(self, args, pot=None):
         """Extract messages to a .pot file, then merge to languages
 
-        Returns the POTFile created
+        Messages are added to pot (a POTFile or POTWriter); if not given,
+        a new POTFile is created.
+
+        Returns the pot
         """
         args.printer('Extracting source messages')
-        pot = POTFile(project_name=self.domain)
-        for message in yield_messages(self.source_dir, args.printer):
+        if pot is None:
+            pot = POTFile(project_name=self.domain)
+        cache = self.get_cache(args)
+        messages = self.yield_messages(args.printer, args.jobs, cache,
+            args.extract_method)
+        for message in messages:
             pot.add(message)
         return pot
 
@@ -80,17 +446,17 @@ class ForrinTools(object):
     def merge(self, args):
         """Merge the source pot file with individual language files
         """
-        pot = self.get_pot(args)
-        for lang in self.get_langs(args):
-            po_path = os.path.join(self.i18n_dir, '%s.po' % lang)
-            if os.path.exists(po_path):
+        index = MergeIndex(self.get_pot(args))
+        langs = self.get_langs(args)
+        po_paths = [os.path.join(self.i18n_dir, '%s.po' % lang)
+            for lang in langs]
+        pos = map_jobs(functools.partial(merge_file, index), po_paths,
+            args.jobs)
+        for lang, po_path, po in zip(langs, po_paths, pos):
+            if po.fpath:
                 args.printer('Merging translations to %s' % po_path)
-                po = polib.pofile(po_path)
-                po.merge(pot)
             else:
                 args.printer('Creating new translation file %s' % po_path)
-                po = polib.POFile()
-                po.merge(pot)
             yield po, lang, po_path
 
     def strip(self, args):
@@ -101,26 +467,102 @@ class ForrinTools(object):
         pos_with_info = self.merge(args)
         for po, lang, po_path in pos_with_info:
             args.printer('Stripping translations in %s' % po_path)
-            po[:] = [m for m in po if m.msgstr]
-            for message in po:
-                message.occurrences = []
-                message.flags = []
-                message.comment = message.tcomment = ''
+            strip_catalog(po)
             yield po, lang, po_path
 
     def save_pos(self, pos_with_info, args):
         for po, lang, po_path in pos_with_info:
-            args.printer('Saving %s' % po_path)
-            po.save(po_path)
+            if save_catalog(po, po_path, args.write):
+                args.printer('Saving %s' % po_path)
+            else:
+                args.printer('No changes in %s' % po_path)
+
+    def update(self, args, strip=False):
+        """Merge source messages to the per-language .po files, and save them
+
+        This does the work of merge (and strip, if strip is true) and
+        save_pos, but each language is handled entirely in a worker process
+        when running with --jobs.
+        Files are only written if their content changes.
+        """
+        index = MergeIndex(self.get_pot(args))
+        po_paths = [os.path.join(self.i18n_dir, '%s.po' % lang)
+            for lang in self.get_langs(args)]
+        results = map_jobs(
+            functools.partial(update_file, index, strip, args.write),
+            po_paths, args.jobs)
+        for po_path, (existed, changed) in zip(po_paths, results):
+            if not existed:
+                args.printer('Creating new translation file %s' % po_path)
+            elif changed:
+                args.printer('Saving %s' % po_path)
+            else:
+                args.printer('No changes in %s' % po_path)
 
-    def print_stats(self, pos_with_info, args):
+    def compile(self, args):
+        """Build the catalog database used by the translator's backend
+
+        Translators with precompiled=True only use this database.
+        """
+        catalogs = []
+        for lang in self.get_langs(args):
+            po_path = os.path.join(self.i18n_dir, '%s.po' % lang)
+            if os.path.exists(po_path):
+                args.printer('Compiling %s' % po_path)
+                catalogs.append((lang, po_path))
+        args.printer('Saving %s' % self.db_name)
+        compile_catalogs(
+            self.db_name, self.translator.package, catalogs, args.write)
+
+    def serve(self, args):
+        """Serve the compiled catalogs on a Unix socket until interrupted
+        """
+        # Unix sockets are not available everywhere
+        import forrin.service
+        socket_name = args.socket or self.socket_name
+        server = forrin.service.TranslationServer(
+            socket_name, self.i18n_dir, self.translator.package,
+            store_path=self.db_name)
+        args.printer('Serving translations on %s' % socket_name)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            os.unlink(socket_name)
+
+    def get_pot_keys(self, args):
+        """Return a frozenset of msgid_with_context of all source messages
+        """
+        if args.cached_pot:
+            return frozenset(key for key, translated
+                in scan_catalog(self.pot_name))
+        else:
+            return frozenset(entry.msgid_with_context
+                for entry in self.extract(args))
+
+    def stats(self, args):
+        """Yield (lang, po_path, n_translated, n_all) for each language
+
+        The counts are read directly from the .po files, without merging
+        them with the source messages.
+        Obsolete translations are not counted.
+        """
+        keys = self.get_pot_keys(args)
+        langs = self.get_langs(args)
+        po_paths = [os.path.join(self.i18n_dir, '%s.po' % lang)
+            for lang in langs]
+        counts = map_jobs(functools.partial(count_translated, keys), po_paths,
+            args.jobs)
+        for lang, po_path, n_translated in zip(langs, po_paths, counts):
+            yield lang, po_path, n_translated, len(keys)
+
+    def print_stats(self, stats, args):
         bar_len = 50
         template = '{lang:5} {bar} {percent:3} {transl:{num_width}}/{all:{num_width}} {path}'
-        pos_with_info = list(pos_with_info)
         results = []
-        for po, lang, po_path in pos_with_info:
-            n_translated = len(po.translated_entries())
-            n_all = len(po)
+        for lang, po_path, n_translated, n_all in stats:
             num_width = len(str(n_all))
             try:
                 completion = n_translated / n_all
@@ -136,7 +578,7 @@ class ForrinTools(object):
             results.append(dict(
                 lang=lang, bar=bar, percent=percent, transl=n_translated,
                 all=n_all, num_width=num_width, path=po_path))
-        results.sort(key=lambda d: (-d['transl'], lang))
+        results.sort(key=lambda d: (-d['transl'], d['lang']))
         for result in results:
             print(template.format(**result))
 
@@ -173,6 +615,17 @@ class ForrinTools(object):
 
                 stats
                     Print stats about available translations
+
+                compile
+                    Build the database of translations used at
+                    runtime, and check it. Do this when deploying
+                    to use translators with precompiled=True,
+                    which never read .po files.
+
+                serve
+                    Serve the compiled translations to other
+                    processes over a Unix socket (see --socket),
+                    for use with forrin.service.ServiceBackend.
                 """).strip(),
             default='help', nargs='?', type=six.text_type)
         parser.add_argument('-h', '--help', dest='action',
@@ -195,6 +648,36 @@ class ForrinTools(object):
                 they are read from an existing pot file.
                 """).strip(),
             dest='cached_pot', action='store_const', const=True, default=False)
+        parser.add_argument('--no-cache',
+            help=textwrap.dedent("""
+                Don't use the extraction cache.
+                By default, messages extracted from each source file
+                are cached in a .forrin-extract file next to the pot
+                file, and only changed files are extracted again.
+                """).strip(),
+            dest='extract_cache', action='store_const', const=False,
+            default=True)
+        parser.add_argument('--tokenize',
+            help=textwrap.dedent("""
+                Find messages using the tokenizer, only parsing
+                the calls themselves rather than whole files.
+                This is faster, but format flags are only guessed.
+                """).strip(),
+            dest='extract_method', action='store_const', const='tokenize',
+            default='ast')
+        parser.add_argument('-j', '--jobs', metavar='N',
+            help=textwrap.dedent("""
+                Number of worker processes to use.
+                Default: 1 (do everything in a single process)
+                """).strip(),
+            type=int, default=1)
+        parser.add_argument('--socket', metavar='PATH',
+            help=textwrap.dedent("""
+                Socket for the serve action.
+                Default: a .forrin-socket file next to the
+                compiled translations
+                """).strip(),
+            type=six.text_type)
         parser.add_argument('-n', '--dry-run',
             help=textwrap.dedent("""
                 Do not write any files, just show what would be done
@@ -214,17 +697,28 @@ class ForrinTools(object):
             parser.print_help()
             exit(1)
         elif action == 'extract':
-            pot = self.extract(args)
             if args.write:
-                args.printer('Saving pot file %s' % self.pot_name)
-                pot.save(self.pot_name)
+                # Stream the messages: don't keep all of them in memory
+                pot = POTWriter(project_name=self.domain)
+                try:
+                    self.extract(args, pot)
+                    args.printer('Saving pot file %s' % self.pot_name)
+                    pot.save(self.pot_name)
+                finally:
+                    pot.close()
+            else:
+                self.extract(args)
         elif action == 'update':
-            self.save_pos(self.merge(args), args)
+            self.update(args)
         elif action == 'strip':
-            self.save_pos(self.strip(args), args)
+            self.update(args, strip=True)
         elif action == 'stats':
             args.printer = lambda *a, **ka: None
-            self.print_stats(self.merge(args), args)
+            self.print_stats(self.stats(args), args)
+        elif action == 'compile':
+            self.compile(args)
+        elif action == 'serve':
+            self.serve(args)
         else:
             parser.error('Unknown action')
 
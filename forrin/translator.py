@@ -5,15 +5,22 @@ import sys
 import os.path
 import warnings
 import operator
+import threading
+import contextlib
 from collections import namedtuple
 
 import six
+from six.moves import cPickle as pickle
 import pkg_resources
 
 import forrin.template
 import forrin.backend
+from forrin.util import atomic_write
 
 
+# Version of the file format written by BaseTranslator.save_snapshot
+SNAPSHOT_VERSION = 1
+
 _Base = namedtuple('_base', 'message plural n context comment')
 
 
@@ -76,6 +83,15 @@ class BaseTranslator(object):
     - dir: the locale directory within `package`. Defaults to "i18n".
     - domain: the domain (aka project identifier) used. By default, same as
         the `package`
+    - precompiled: if true, use the catalog database built by the `compile`
+        action of forrin.tools, and never read .po files. Default: False
+    - source_language: the language messages are written in. Translators
+        whose first language is the source language, which has no catalog,
+        return messages as they are, ignoring fallback languages.
+        Default: "en"
+    - catalog_store: absolute path of a catalog database to share with
+        other translators (e.g. of other packages); they all use one
+        connection. By default, each domain has its own database.
 
     Constructor parameters are
     - languages: a list of language identifiers; first is the one we want to
@@ -84,9 +100,17 @@ class BaseTranslator(object):
         entirely. The given object must support `gettext` and `ngettext`
         methods, with API defined by the Python gettext module. (For Python 2,
         these should use Unicode, i.e. gettext's ugettext & ungettext.)
+        If languages are also given, the first one is used for templates.
+        See forrin.service.ServiceBackend for translations from a shared
+        translation service.
     - directory: can be used to override the po-file directory. Divined from
         the package & dir class attributes if missing.
     - package: override the class-level package attribute
+    - recorder: a forrin.instrument.Recorder to record what the translator,
+        its backend, and the Templates it creates are doing
+    - precompiled: override the class-level precompiled attribute
+    - profile: a forrin.instrument.MessageProfile to record which messages
+        are requested. See preload.
 
     Notes
     -----
@@ -104,6 +128,9 @@ class BaseTranslator(object):
     Unicode is used everywhere.
     """
     dir = 'i18n'
+    precompiled = False
+    source_language = 'en'
+    catalog_store = None
 
     @property
     def i18n_directory(self):
@@ -137,9 +164,18 @@ class BaseTranslator(object):
             translations=None,
             directory=None,
             package=None,
+            recorder=None,
+            precompiled=None,
+            profile=None,
         ):
         self.package = package or getattr(self, 'package', self.__module__)
         self.domain = getattr(self, 'domain', self.package)
+        self.recorder = recorder
+        self.profile = profile
+        # Templates for translated @-messages, shared between calls
+        self._templates = {}
+        if precompiled is not None:
+            self.precompiled = precompiled
         if translations is None:
             if languages is None:
                 self.translation = NullTranslations()
@@ -147,12 +183,36 @@ class BaseTranslator(object):
             else:
                 if directory is None:
                     directory = self.i18n_directory
+                if self.catalog_store and languages:
+                    if not os.path.isabs(self.catalog_store):
+                        raise ValueError(
+                            'catalog_store must be an absolute path: %r' % (
+                                self.catalog_store, ))
+                    store = forrin.backend.get_store(
+                        self.catalog_store, readonly=self.precompiled)
+                else:
+                    store = None
                 self.translation = forrin.backend.SQLiteBackend(
-                    self.package, directory, languages)
+                    self.package, directory, languages, store=store,
+                    recorder=recorder, precompiled=self.precompiled)
                 self.language = languages[0]
+                if (languages and languages[0] == self.source_language and
+                        self.translation.languages[:1] != languages[:1]):
+                    # Messages are already in the requested language, and
+                    # there's no catalog to adjust them
+                    self.translation = NullTranslations()
         else:
             self.translation = translations
-            self.language = None
+            if languages:
+                self.language = languages[0]
+            else:
+                self.language = None
+        # With no catalogs to use, messages are returned as they are;
+        # __call__ has a fast path for that.
+        self.source_mode = recorder is None and profile is None and (
+            isinstance(self.translation, NullTranslations) or (
+                isinstance(self.translation, forrin.backend.SQLiteBackend)
+                and not self.translation.languages))
 
     def __call__(self, message, plural=None, n=None,
             context=None, comment=None):
@@ -161,6 +221,20 @@ class BaseTranslator(object):
                     "Translatable strings don't need extra information"
                 )
             return self(*message)
+        if self.source_mode:
+            if n is not None and n != 1:
+                message = plural
+            if message and message[0] == '@':
+                try:
+                    return self._templates[message]
+                except KeyError:
+                    return self.make_template(message)
+            return message
+        if self.profile is not None:
+            self.profile.record(message, plural, context)
+        recorder = self.recorder
+        if recorder is not None:
+            start = recorder.clock()
         if context:
             prefix = context + '|'
         else:
@@ -177,32 +251,315 @@ class BaseTranslator(object):
             prefix, sep, translated = translated.partition('|')
             if not sep:
                 translated = prefix
-        return handle_template(translated, self.language)
-
-
-def handle_template(message, language='en'):
-    if message and message[0] == '@':
-        if language:
+        if translated and translated[0] == '@':
             try:
-                mod = __import__('forrin.' + language, fromlist='Template')
-                Template = mod.Template
-            except (ImportError, AttributeError) as e:
-                Template = forrin.template.Template
+                result = self._templates[translated]
+            except KeyError:
+                result = self.make_template(translated)
         else:
-            Template = forrin.template.Template
-        return Template(message[1:])
+            result = translated
+        if recorder is not None:
+            recorder.add_time('translate', start)
+        return result
+
+    def make_template(self, translated):
+        """Create, compile and cache the template for an @-message"""
+        template = handle_template(translated, self.language, self.recorder)
+        template.formatter.compile(template, self.recorder)
+        self._templates[translated] = template
+        return template
+
+    # Numbers used to preload plural messages, covering the usual forms
+    preload_numbers = 1, 2, 5
+
+    def preload(self, messages):
+        """Load translations of the given messages, and compile templates
+
+        messages is a list of (message, plural, context) tuples, as returned
+        by forrin.instrument.load_profile.
+        If the backend has a preload method, it's given the catalog keys
+        of all the messages first.
+        Translating the messages creates and compiles their templates.
+        """
+        messages = list(messages)
+        preload = getattr(self.translation, 'preload', None)
+        if preload is not None:
+            preload([context + '|' + message if context else message
+                for message, plural, context in messages])
+        profile, self.profile = self.profile, None
+        try:
+            for message, plural, context in messages:
+                if plural is None:
+                    self(message, context=context)
+                else:
+                    for n in self.preload_numbers:
+                        self(message, plural, n, context)
+        finally:
+            self.profile = profile
+
+    def save_snapshot(self, filename):
+        """Save the warmed-up state of this translator, for restore_snapshot
+
+        The snapshot holds the catalogs loaded by the backend (if it has
+        a snapshot method, like SQLiteBackend), and the compiled templates.
+        Use preload or translate some messages first.
+        """
+        snapshot = getattr(self.translation, 'snapshot', None)
+        template_formatter = template_class(self.language).formatter
+        data = dict(
+            version=SNAPSHOT_VERSION,
+            domain=self.domain,
+            language=self.language,
+            translations=snapshot() if snapshot is not None else None,
+            templates=list(self._templates),
+            formatter=template_formatter.snapshot(
+                translated[1:] for translated in self._templates),
+        )
+        # Readers never see a partially written snapshot
+        with atomic_write(filename) as tmp_path:
+            with open(tmp_path, 'wb') as fileobj:
+                pickle.dump(data, fileobj, pickle.HIGHEST_PROTOCOL)
+
+    def restore_snapshot(self, filename):
+        """Restore the state saved by save_snapshot
+
+        Returns True if the snapshot was restored. If it is stale (a catalog
+        changed since it was saved), was saved by a different translator
+        or version of forrin, or can't be read (for example, it doesn't
+        exist yet), nothing is restored and False is returned.
+        """
+        try:
+            with open(filename, 'rb') as fileobj:
+                data = pickle.load(fileobj)
+        except (IOError, OSError, EOFError, pickle.UnpicklingError,
+                AttributeError, ImportError, IndexError, TypeError,
+                ValueError):
+            return False
+        if not isinstance(data, dict) or (
+                data.get('version') != SNAPSHOT_VERSION or
+                data['domain'] != self.domain or
+                data['language'] != self.language):
+            return False
+        if data['translations'] is not None:
+            restore = getattr(self.translation, 'restore', None)
+            if restore is None or not restore(data['translations']):
+                return False
+        template_class(self.language).formatter.restore(data['formatter'])
+        for translated in data['templates']:
+            if translated not in self._templates:
+                self.make_template(translated)
+        return True
+
+
+def handle_template(message, language='en', recorder=None):
+    if message and message[0] == '@':
+        template = template_class(language)(message[1:])
+        if recorder is not None:
+            recorder.count('template.create')
+            template.recorder = recorder
+        return template
     return message
 
 
+def template_class(language):
+    """Return the Template class for the given language
+
+    That's the Template from the forrin module named after the language,
+    or BaseTemplate if there's none.
+    """
+    try:
+        return _template_classes[language]
+    except KeyError:
+        pass
+    Template = forrin.template.BaseTemplate
+    if language:
+        try:
+            mod = __import__('forrin.' + language, fromlist='Template')
+            Template = mod.Template
+        except (ImportError, AttributeError) as e:
+            pass
+    _template_classes[language] = Template
+    return Template
+
+_template_classes = {}
+
+
+_active = threading.local()
+
+
+def get_languages():
+    """Return the languages active in the current thread, or None"""
+    return getattr(_active, 'languages', None)
+
+
+def set_languages(languages):
+    """Set the languages used by LazyStrings in the current thread"""
+    _active.languages = tuple(languages) if languages else None
+
+
+@contextlib.contextmanager
+def active_languages(languages):
+    """Context manager to set the active languages temporarily"""
+    previous = get_languages()
+    set_languages(languages)
+    try:
+        yield
+    finally:
+        set_languages(previous)
+
+
+class LazyTranslator(object):
+    """A callable like a translator, but returning LazyStrings
+
+    LazyStrings are translated when they're used, for the languages active
+    at that time (see active_languages), so they can be created at import
+    time.
+    Translators are created as translator_class(languages=..., **options)
+    when first needed for a given set of languages, and then reused.
+    """
+    def __init__(self, translator_class, **options):
+        self.translator_class = translator_class
+        self.options = options
+        self.translators = {}
+
+    def translator(self, languages):
+        """Return the translator for the given tuple of languages (or None)
+        """
+        try:
+            return self.translators[languages]
+        except KeyError:
+            translator = self.translators[languages] = self.translator_class(
+                languages=list(languages) if languages else None,
+                **self.options)
+            return translator
+
+    def __call__(self, message, plural=None, n=None, context=None,
+            comment=None):
+        return LazyString(self, TranslatableString(
+            message, plural, n, context, comment))
+
+
+class LazyString(object):
+    """A message that is translated when used as a string
+
+    Translations are cached per active languages.
+    Most string operations work on the translation; methods not defined
+    here (like format) are looked up on it.
+    LazyStrings compare and hash like their translation, so as dict keys
+    or set items, they are only found while the same languages are active.
+    """
+    __slots__ = ('lazy_translator', 'message', '_cache')
+
+    def __init__(self, lazy_translator, message):
+        self.lazy_translator = lazy_translator
+        self.message = message
+        self._cache = {}
+
+    def resolve(self):
+        """Return the translation for the active languages"""
+        languages = get_languages()
+        try:
+            return self._cache[languages]
+        except KeyError:
+            translator = self.lazy_translator.translator(languages)
+            result = self._cache[languages] = translator(self.message)
+            return result
+
+    def __unicode__(self):
+        return six.text_type(self.resolve())
+
+    if six.PY2:
+        def __str__(self):
+            return self.__unicode__().encode('utf-8')
+    else:
+        __str__ = __unicode__
+
+    def __repr__(self):
+        return '<LazyString %r at 0x%08x>' % (self.message.message, id(self))
+
+    def __getattr__(self, name):
+        # Special names are looked up by copy, pickle and the like, possibly
+        # before the slots are set; they must not resolve the message
+        if name in LazyString.__slots__ or (
+                name.startswith('__') and name.endswith('__')):
+            raise AttributeError(name)
+        return getattr(self.resolve(), name)
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
+    def __format__(self, format_spec):
+        return format(self.resolve(), format_spec)
+
+    def __len__(self):
+        return len(self.resolve())
+
+    def __iter__(self):
+        return iter(self.resolve())
+
+    def __contains__(self, item):
+        return item in self.resolve()
+
+    def __getitem__(self, key):
+        return self.resolve()[key]
+
+    def __add__(self, other):
+        return self.resolve() + other
+
+    def __radd__(self, other):
+        return other + self.resolve()
+
+    def __mod__(self, other):
+        return self.resolve() % other
+
+    def __mul__(self, other):
+        return self.resolve() * other
+
+    def __hash__(self):
+        return hash(self.resolve())
+
+    def __eq__(self, other):
+        return self.resolve() == other
+
+    def __ne__(self, other):
+        return self.resolve() != other
+
+    def __lt__(self, other):
+        return self.resolve() < other
+
+    def __le__(self, other):
+        return self.resolve() <= other
+
+    def __gt__(self, other):
+        return self.resolve() > other
+
+    def __ge__(self, other):
+        return self.resolve() >= other
+
+
 class NullTranslator(object):
     """Looks like a Translator, quacks like a Translator, but doesn't actually
     translate
     """
-    def __init__(*stuff, **more_stuff):
-        pass
+    def __init__(self, *stuff, **more_stuff):
+        self._templates = {}
 
-    def __call__(self, message, *stuff, **more_stuff):
-        return handle_template(message)
+    def __call__(self, message, plural=None, n=None, context=None,
+            comment=None):
+        if isinstance(message, TranslatableString):
+            return self(*message)
+        if n is not None and n != 1:
+            message = plural
+        if message and message[0] == '@':
+            try:
+                return self._templates[message]
+            except KeyError:
+                template = self._templates[message] = handle_template(message)
+                return template
+        return message
 
 class NullTranslations(object):
     def gettext(self, msgid):
@@ -1,3 +1,10 @@
+import os
+import errno
+import shutil
+import binascii
+import contextlib
+
+
 
 
 # Stolen from the Pyramid project
@@ -19,3 +26,54 @@ class reify(object):
         val = self.wrapped(inst)
         setattr(inst, self.wrapped.__name__, val)
         return val
+
+
+# os.replace is atomic on all platforms; Python 2 only has os.rename
+replace_file = getattr(os, 'replace', os.rename)
+
+
+@contextlib.contextmanager
+def atomic_write(path, replace=True):
+    """Yield the name of a new temporary file, which then replaces path
+
+    The temporary file is created next to path. When the block ends, it
+    atomically replaces path (if replace is true), so readers never see
+    a partially written file. Otherwise, or on error, it is removed.
+
+    The new file keeps the mode of path. If path doesn't exist, it has
+    the mode of any newly created file.
+    """
+    tmp_path = _create_temp_file(path)
+    try:
+        yield tmp_path
+        if replace:
+            try:
+                shutil.copymode(path, tmp_path)
+            except (IOError, OSError):
+                # path doesn't exist yet
+                pass
+            replace_file(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+
+
+def _create_temp_file(path):
+    """Create an empty file next to path, with a unique name; return it
+
+    Unlike tempfile.mkstemp, the file gets the default mode (0666 minus
+    the umask), not 0600.
+    """
+    directory, basename = os.path.split(path)
+    while True:
+        tmp_path = os.path.join(directory, '.%s.%s.tmp' % (
+            basename, binascii.hexlify(os.urandom(6)).decode('ascii')))
+        try:
+            fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL,
+                0o666)
+        except OSError as e:
+            if e.errno == errno.EEXIST:
+                continue
+            raise
+        os.close(fd)
+        return tmp_path